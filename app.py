@@ -1,56 +1,149 @@
 import dash
-import math
 import numpy as np
 import pandas as pd
-import json
-import geojson
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
-import platform
-import plotly.express as px
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
+import os
+import threading
+import time
+import uuid
 import plotly.graph_objs as go
-from screeninfo import get_monitors
+import flask
+from cube import PrefixCube
+import datastore
+import geometry
+import tiles
+from cache import LRUCache, FileCache, TieredCache, memoize
+from metrics import stage, timed, timed_job, instrument
+from jobs import JobQueue
+from encoding import encode_figure
+from drilldown import TaxiSeriesIndex, TaxiDailyIndex, CovidSeriesIndex, load_events
+from overlap import load_overlap
+from transforms import amount_columns, ratio_columns
 
 import datetime
-from dateutil.relativedelta import *
    
 map_data_path = "map_data/"
 covid_data_path = "covid_data/"
-taxi_data_path = "taxi_data/"
-taxi_zone_path = "taxi_data/by_zone/"
-
-# taxi zones
-with open(map_data_path + "taxi_zones_2_simpler.json") as f:
-    taxigj = geojson.load(f)
-nzones = len(taxigj["features"])
-taxi_lookup = {int(feature["properties"]["location_id"]) : feature
-                for feature in taxigj["features"]}
-
-# taxi data
-taxidfMonths = []
-for monthID in range(1, 13):
-    dfmonth = pd.read_csv(taxi_data_path + "taxi_data_2019-" + f"{monthID:02}" + ".csv")
-    taxidfMonths.append(dfmonth)
-for monthID in range(1, 13):
-    dfmonth = pd.read_csv(taxi_data_path + "taxi_data_2020-" + f"{monthID:02}" + ".csv")
-    taxidfMonths.append(dfmonth)
-
-# covid zones (zip codes)
-with open(map_data_path + "zip_codes_simpler.json") as f:
-    covidgj = geojson.load(f)
-nzips = len(covidgj["features"])
-zip_lookup = {int(feature["properties"]["postalCode"]) : feature
-                for feature in covidgj["features"]}
-
-# covid data
-coviddfMonths = []
-for monthID in range(1, 13):
-    dfmonth = pd.read_csv(covid_data_path + "covid_data-2020-" + str(monthID) + ".csv")
-    coviddfMonths.append(dfmonth)
+# caches shared by the worker processes, CACHE_PATH overrides the directory
+cache_path = os.environ.get("CACHE_PATH", "cache/")
+# WARMUP=0 skips pre-rendering the figures in the background
+warmup = os.environ.get("WARMUP") != "0"
+# VECTOR_TILES=1 draws the maps from the store's vector tiles (see tiles.py)
+# instead of the geojson levels of detail, the figures then only carry the
+# per-zone values and colors. A store built without shapely has no tiles, the
+# maps are then drawn from the geojson
+vector_tiles = os.environ.get("VECTOR_TILES") == "1"
+# color classes of the continuous color scales in tile mode
+tile_classes = 16
+# zones or zips of a selection drawn as their own drilldown series, larger
+# selections are drawn as one aggregate of the whole selection
+drilldown_series = 10
+# the drilldowns are built in the background by a pool of threads per worker
+# process, and the page polls for them every drilldown_poll milliseconds
+drilldown_workers = 2
+drilldown_poll = 250
+
+# the zone and zip geometry is not loaded by the workers: the browser fetches
+# it from the store's geometry files (see serve_geometry), the figures are
+# built against an empty collection and only carry the per-zone arrays
+emptygj = {"type": "FeatureCollection", "features": []}
+
+# taxi and covid data
+class DashboardData:
+    # arrays and indexes of one build of the store, the slider positions are
+    # indexes into its consecutive months
+    def __init__(self, store):
+        self.store = store
+        self.build = store.build
+        self.months = store.months.tolist()
+        self.taxi_attributes = store.zone_attributes()
+        # month x {yellow, green} x zone revenue, as prefix sums over the
+        # months, memory-mapped from the store like the other arrays
+        self.taxicube = PrefixCube(cumsum=store.taxi_revenue_cumsum)
+        self.covid_zips = store.zip_codes.astype(np.int64)
+        # month x zip hospitalization rate on the same timeline as the taxi
+        # data, 0 before the covid data starts
+        self.covidcube = PrefixCube(cumsum=store.covid_rate_cumsum)
+        # drilldown series
+        self.taxiseries = TaxiSeriesIndex(store)
+        self.covidseries = CovidSeriesIndex(store)
+        # daily taxi data, for the months that have it
+        self.taxidays = TaxiDailyIndex(store)
+        # vector tiles of each map
+        self.tiles = {}
+        if vector_tiles and tiles.has_tiles(store.path):
+            self.tiles = {mapID : tiles.TileIndex(store.path, mapID)
+                            for mapID in geometry.geometry_sources}
+        elif vector_tiles:
+            app.logger.warning("the store has no vector tiles (shapely was not installed when it "
+                               "was built), the maps are drawn from the geojson")
+
+        # first month with covid cases, the ratio view compares each month
+        # from there on with the same month a year earlier
+        nmonths = len(self.months)
+        covidMonths = np.flatnonzero(np.any(store.covid_rate, axis=1))
+        firstCovidMonth = covidMonths[0] if len(covidMonths) else nmonths - 1
+        self.ratio_start = int(min(max(firstCovidMonth, 12), nmonths - 1))
+        # january of the first covid year
+        self.covid_start = int(max(firstCovidMonth - (int(self.months[firstCovidMonth][5:]) - 1), 0))
+
+    def dates(self, start, end):
+        return [datetime.datetime.strptime(month, "%Y-%m") for month in self.months[start:end + 1]]
+
+    def date_range(self, start, end):
+        # first and last day of the months start..end
+        return (np.datetime64(self.months[start], "D"),
+                (np.datetime64(self.months[end], "M") + 1).astype("datetime64[D]") - 1)
+
+# the store is memory-mapped and reloaded when it was rebuilt or updated
+# (python ingest.py --update), which is checked at most every
+# refresh_interval seconds, so new months show up without a restart
+# Nothing is loaded at import: the store is memory-mapped (and built if
+# needed) on first use, by the warmup thread or the first request, whichever
+# comes first, so that the server answers right away
+refresh_interval = 30
+data = None
+data_lock = threading.Lock()
+data_checked = time.monotonic()
+
+def current_data(refresh=False):
+    # refresh checks the store right away
+    global data, data_checked
+    with data_lock:
+        if data is None:
+            data = DashboardData(datastore.load())
+            data_checked = time.monotonic()
+        elif refresh or time.monotonic() - data_checked >= refresh_interval:
+            data_checked = time.monotonic()
+            if datastore.store_build_at(datastore.store_path) not in (None, data.build):
+                data = DashboardData(datastore.DataStore())
+        return data
+
+class StaleBuild(PreventUpdate):
+    # the inputs of a callback are of a build the store replaced, the page
+    # is moved to the current one by update_data_build
+    pass
+
+def build_data(build):
+    # data of the given build, for the results cached under it: a build this
+    # worker has not loaded yet, e.g. one another worker passed to the page,
+    # reloads the store without waiting for refresh_interval, and StaleBuild
+    # is raised for any other build, so that nothing is ever computed from the
+    # data of another build than the one in its key
+    data = current_data()
+    if data.build != build:
+        data = current_data(refresh=True)
+        if data.build != build:
+            raise StaleBuild(build)
+    return data
+
+events_data = load_events(covid_data_path + "nyc_events.csv")
 
 # zone overlap
-overlapdf = pd.read_csv(map_data_path + "taxi_zip_overlap.csv")
+overlap = load_overlap(map_data_path + "taxi_zip_overlap.csv")
 
 # taxi bivariate color map
 nbiv_colors = 9
@@ -60,42 +153,30 @@ biv_colors = [  "#e8e8e8", "#b5c0da", "#6c83b5",
 bivcmap = {clr : clr for clr in biv_colors}
 
 # slider marks
-ratio_marks = { 0  : {"label": "Jan.", 'style':{'font-size':'20px'}},
-                1  : {"label": "Feb.", 'style': {'font-size':'20px'}},
-                2  : {"label": "2020 Mar.", "style":{"color": "#77b0b1", "font-size":"20px"}},
-                3  : {"label": "Apr.", "style":{"font-size":"20px"}},
-                4  : {"label": "May","style":{"font-size":"20px"}},
-                5  : {"label": "Jun.", "style":{"font-size":"20px"}},
-                6  : {"label": "Jul.", "style":{"font-size":"20px"}},
-                7  : {"label": "Aug.", "style":{"font-size":"20px"}},
-                8  : {"label": "Sep.", "style":{"font-size":"20px"}},
-                9  : {"label": "Oct.", "style":{"font-size":"20px"}},
-                10 : {"label": "Nov.", "style":{"font-size":"20px"}},
-                11 : {"label": "Dec.", "style":{"font-size":"20px"}}}
-rawrevenue_marks = {0  : {"label": "2019", "style":{"color": "#77b0b1", "font-size":"20px"}},
-                    1  : {"label": "Feb.", "style":{"font-size":"20px"}},
-                    2  : {"label": "Mar.", "style":{"font-size":"20px"}},
-                    3  : {"label": "Apr.", "style":{"font-size":"20px"}},
-                    4  : {"label": "May", "style":{"font-size":"20px"}},
-                    5  : {"label": "Jun.", "style":{"font-size":"20px"}},
-                    6  : {"label": "Jul.", "style":{"font-size":"20px"}},
-                    7  : {"label": "Aug.", "style":{"font-size":"20px"}},
-                    8  : {"label": "Sep.", "style":{"font-size":"20px"}},
-                    9  : {"label": "Oct.", "style":{"font-size":"20px"}},
-                    10 : {"label": "Nov.", "style":{"font-size":"20px"}},
-                    11 : {"label": "Dec.", "style":{"font-size":"20px"}},
-                    12 : {"label": "2020", "style":{"color": "#77b0b1", "font-size":"20px"}},
-                    13 : {"label": "Feb.", "style":{"font-size":"20px"}},
-                    14 : {"label": "Mar.", "style":{"font-size":"20px"}},
-                    15 : {"label": "Apr.", "style":{"font-size":"20px"}},
-                    16 : {"label": "May", "style":{"font-size":"20px"}},
-                    17 : {"label": "Jun.", "style":{"font-size":"20px"}},
-                    18 : {"label": "Jul.", "style":{"font-size":"20px"}},
-                    19 : {"label": "Aug.", "style":{"font-size":"20px"}},
-                    20 : {"label": "Sep.", "style":{"font-size":"20px"}},
-                    21 : {"label": "Oct.", "style":{"font-size":"20px"}},
-                    22 : {"label": "Nov.", "style":{"font-size":"20px"}},
-                    23 : {"label": "Dec.", "style":{"font-size":"20px"}}}
+month_labels = ["Jan.", "Feb.", "Mar.", "Apr.", "May", "Jun.",
+                "Jul.", "Aug.", "Sep.", "Oct.", "Nov.", "Dec."]
+
+def slider_marks(months, first):
+    # marks of months[first:], the first mark and januaries show the year
+    marks = {}
+    for i in range(first, len(months)):
+        year, month = months[i].split("-")
+        label = month_labels[int(month) - 1]
+        if month == "01":
+            marks[i] = {"label": year, "style":{"color": "#77b0b1", "font-size":"20px"}}
+        elif i == first:
+            marks[i] = {"label": year + " " + label, "style":{"color": "#77b0b1", "font-size":"20px"}}
+        else:
+            marks[i] = {"label": label, "style":{"font-size":"20px"}}
+    return marks
+
+def slider_view(data, isRatioView):
+    # min, max, marks and initial value of the slider in the given view
+    last = len(data.months) - 1
+    if isRatioView:
+        return data.ratio_start, last, slider_marks(data.months, data.ratio_start), \
+                [data.ratio_start, data.ratio_start]
+    return 0, last, slider_marks(data.months, 0), [data.covid_start, data.covid_start]
 
 # helper funcs. about data
 def colors_to_colorscale(biv_colors):
@@ -130,62 +211,52 @@ def colorsquare(text_x, text_y, colorscale, n=3):
                       colorscale=colorscale,
                       showscale=False)
 
-def myLog(x):
-    return np.log(x) if (x > 0) else 0
-
-def sigmoid(x):
-    return 1 / (1 + math.exp(-x))
-
-def newLog(x):
-    if x<= 0:
-        return x
-    return np.log(x+1)
-    # return np.sign(x)*np.log(abs(x)+1)
-
-def set_interval_value(x, a, b):
-    # function that associate to a float x, 
-    # a value encoding its position with respect to the interval [a, b]
-    #  the associated values are 0, 1, 2 assigned as follows:
-    if x <= a: 
-        return 0
-    elif a < x <= b: 
-        return 1
-    else: 
-        return 2
-    
-def data2color(x, y, a, b, c, d, biv_colors):
-    # This function works only with a list of 9 bivariate colors,
-    # because of the definition of set_interval_value()
-    # x, y: lists or 1d arrays, containing values of the two variables
-    #  each x[k], y[k] is mapped to an int  value xv, respectively yv, representing its category,
-    # from which we get their corresponding color  in the list of bivariate colors
-    if len(x) != len(y):
-        raise ValueError('the list of x and y-coordinates must have the same length')
-    n_colors = len(biv_colors)
-    if n_colors != 9:
-        raise ValueError('the list of bivariate colors must have the length eaqual to 9')
-    n = 3    
-    xcol = [set_interval_value(v, a, b) for v in x]
-    ycol = [set_interval_value(v, c, d) for v in y]
-    # index of the corresponding color in the list of bivariate colors
-    idxcol = [int(xc + n*yc) for xc, yc in zip(xcol,ycol)]
-    colors = np.array(biv_colors)[idxcol]
-    return list(colors)
-
 # dash app
 app = dash.Dash(
     __name__,
     external_stylesheets=[
         'https://codepen.io/chriddyp/pen/bWLwgP.css'
+    ],
+    external_scripts=[
+        '/geometry.js'
     ]
 )
 
-# figures, set chorepleth height
-choroplethHeight = 0.6*get_monitors()[0].height
+@app.server.route("/geometry.js")
+def serve_geometry_levels():
+    # window.choroplethGeometryLevels, the levels of detail of each map
+    return flask.send_file(os.path.join(datastore.store_path, geometry.geometry_script),
+                           mimetype="application/javascript", max_age=24 * 3600)
+
+@app.server.route("/geometry/<map_id>/<int:level>.json")
+def serve_geometry(map_id, level):
+    # geojson of a map at a level of detail, written by datastore.py and
+    # streamed from the file, so no worker parses it
+    return flask.send_from_directory(os.path.join(datastore.store_path, geometry.geometry_path),
+                                     "{}-{}.json".format(map_id, level),
+                                     mimetype="application/json", max_age=24 * 3600)
+
+@app.server.route("/tiles/<map_id>/<int:z>/<int:x>/<int:y>.pbf")
+def serve_tile(map_id, z, x, y):
+    # vector tile of the boundaries of a map with the ids of the ids
+    # parameter, one color class of the map (see tiled_figure)
+    index = current_data().tiles.get(map_id)
+    if index is None:
+        flask.abort(404)
+    try:
+        ids = {int(i) for i in flask.request.args.get("ids", "").split(",") if i}
+    except ValueError:
+        flask.abort(400)
+    response = flask.make_response(index.tile(z, x, y, ids, tile_layer))
+    response.headers["Content-Type"] = "application/vnd.mapbox-vector-tile"
+    response.cache_control.max_age = 24 * 3600
+    return response
+
+# figures, sized by the browser window (see serve_layout)
+choroplethHeight = "60vh"
+legendSize = "30vh"
 defaultCenter = {"lat":40.7, "lon":-73.97}
 defaultZoom = 10.62
-if platform.system() == 'Darwin':
-    choroplethHeight *= 3
 
 # bivariate legend
 @app.callback(
@@ -193,6 +264,7 @@ if platform.system() == 'Darwin':
 , [
     Input("is-bivariate-view", "data"),
 ])
+@timed
 def update_taxilegend(isBivariateView):
     taxilegend = go.Figure(layout=dict(
         paper_bgcolor='rgba(0,0,0,0)',
@@ -201,18 +273,13 @@ def update_taxilegend(isBivariateView):
     taxilegend.update_yaxes(visible=False)
     if isBivariateView:
         taxilegend = None
-        legendHeight = legendWidth = 3/10*get_monitors()[0].height
-        if platform.system() == 'Darwin':
-            legendHeight *= 2
-            legendWidth *= 2
         text_x = ['yellow revenue<P_33', 'P_33<=yellow revenue<=P_66', 'yellow_revenue>P_66']
         text_y = ['green revenue<P_33', 'P_33<=green revenue<=P_66', 'green revenue>P_66']
         legend_axis = dict(showline=False, zeroline=False, showgrid=False,  ticks='', showticklabels=False)
         taxilegend = go.Figure(
                         data=colorsquare(text_x, text_y, colors_to_colorscale(biv_colors)),
                         layout=dict(xaxis=dict(legend_axis, side="bottom"),
-                                    yaxis=legend_axis,
-                                    height=legendHeight, width=legendWidth))
+                                    yaxis=legend_axis))
         taxilegend.update_xaxes(
                 tickangle = 90,
                 title_text = "yellow taxi revenue",
@@ -239,29 +306,31 @@ def update_taxilegend(isBivariateView):
                 showticklabels=True)
     return taxilegend
 
-dummy_df = pd.DataFrame({
-    "Fruit": ["Apples", "Oranges", "Bananas", "Apples", "Oranges", "Bananas"],
-    "Amount": [4, 1, 2, 2, 4, 5],
-    "City": ["SF", "SF", "SF", "Montreal", "Montreal", "Montreal"]
-})
-
-dummy_fig = px.bar(dummy_df, x="Fruit", y="Amount", color="City", barmode="group")
-
-def get_highlights(selections, geojson, lookup_dict):
-    highlights = dict()
-    for k in geojson.keys():
-        if k != "features":
-            highlights[k] = geojson[k]
-        else:
-            highlights[k] = [lookup_dict[selection] for selection in selections]
-
-    return highlights
-
+# the zones are selected by a click, shift-click, box or lasso on either map
+# (clickmode "select"), the selection is sent as selectedData
+def add_selection(fig, selectedLocs, featureidkey):
+    # marks the selected locations as the selection of the choropleth traces,
+    # so that a redrawn map keeps it and a shift-click adds to it, without
+    # dimming the others, and outlines all of them with one trace drawn
+    # above, which leaves the hover and clicks to the choropleth
+    selected = set(selectedLocs)
+    for trace in fig.data:
+        trace.selectedpoints = [i for i, location in enumerate(trace.locations) if location in selected]
+        trace.unselected = {"marker": {"opacity": 1 if trace.marker.opacity is None else trace.marker.opacity}}
+    fig.add_trace(go.Choroplethmapbox(geojson=emptygj, locations=list(selectedLocs),
+                                      z=np.zeros(len(selectedLocs)), featureidkey=featureidkey,
+                                      colorscale=[[0, "rgba(0,0,0,0)"], [1, "rgba(0,0,0,0)"]],
+                                      showscale=False, hoverinfo="skip",
+                                      marker_line=dict(color="red", width=5)))
+
+# plotly.express is imported by the functions that use it, on first use
+@stage("figure")
 def get_taxifig(selectedLocs, tdf, hover_data, coloring, isBivariateView, newCenter, newZoom):
+    import plotly.express as px
     # clear traces
     taxifig = None
     if isBivariateView:
-        taxifig = px.choropleth_mapbox(tdf, geojson=taxigj,
+        taxifig = px.choropleth_mapbox(tdf, geojson=emptygj,
                                 locations="PULocationID", 
                                 color=coloring,
                                 color_discrete_map=bivcmap,
@@ -270,7 +339,7 @@ def get_taxifig(selectedLocs, tdf, hover_data, coloring, isBivariateView, newCen
                                 featureidkey="properties.location_id",
                                 center=newCenter, zoom=newZoom)
     else:
-        taxifig = px.choropleth_mapbox(tdf, geojson=taxigj,
+        taxifig = px.choropleth_mapbox(tdf, geojson=emptygj,
                                locations="PULocationID", 
                                 color=coloring,
                                 color_continuous_scale="Viridis",
@@ -280,35 +349,25 @@ def get_taxifig(selectedLocs, tdf, hover_data, coloring, isBivariateView, newCen
                                 center=newCenter, zoom=newZoom)
 
     if (len(selectedLocs) > 0):
-        highlights = get_highlights(selectedLocs, taxigj, taxi_lookup)
-        taxiHighlights = px.choropleth_mapbox(tdf.loc[tdf["PULocationID"].isin(selectedLocs)],
-                                        geojson=highlights,
-                                        locations="PULocationID", color=coloring,
-                                        color_discrete_map=bivcmap,
-                                        hover_name="Zone",
-                                        hover_data=hover_data,
-                                        featureidkey="properties.location_id",
-                                        center=newCenter)
-        taxiHighlights.update_traces(marker_line=dict(color="red", width=5))
-        for i in range(len(taxiHighlights.data)):
-            taxifig.add_trace(taxiHighlights.data[i])
+        add_selection(taxifig, selectedLocs, "properties.location_id")
 
     taxifig.update_geos(fitbounds="locations", visible=False)
     taxifig.update_layout(
         mapbox_style="carto-positron",
         margin={"r":0,"t":0,"l":0,"b":0},
-        height=choroplethHeight,
         showlegend=False,
-        modebar_remove=["pan", "select2d", "lasso2d"])
+        clickmode="select")
 
     return taxifig
             
+@stage("figure")
 def get_covidfig(selectedZips, cdf, newCenter, newZoom):
+    import plotly.express as px
     # clear traces
     opacity = 1
     if list(set(cdf['hospitalization_rate'])) == [0]:
         opacity = 0
-    covidfig = px.choropleth_mapbox(cdf, geojson=covidgj,
+    covidfig = px.choropleth_mapbox(cdf, geojson=emptygj,
                             locations="zip_code", color="hospitalization_rate",
                             color_continuous_scale="thermal",
                             opacity = opacity,
@@ -321,212 +380,255 @@ def get_covidfig(selectedZips, cdf, newCenter, newZoom):
                             zoom=newZoom)
 
     if (len(selectedZips) > 0):
-        highlights = get_highlights(selectedZips, covidgj, zip_lookup)
-        covidHighlights = px.choropleth_mapbox(cdf.loc[cdf["zip_code"].isin(selectedZips)],
-                                        geojson=highlights,
-                                        locations="zip_code", color="hospitalization_rate",
-                                        color_continuous_scale="thermal",
-                                        opacity = opacity,
-                                        hover_name="zip_code",
-                                        hover_data={
-                                            "hospitalization_rate" : ":.2f",
-                                            "zip_code" : False},
-                                        featureidkey="properties.postalCode",
-                                        center=newCenter)
-        covidHighlights.update_traces(marker_line=dict(color="red", width=5))
-        covidfig.add_trace(covidHighlights.data[0])
+        add_selection(covidfig, selectedZips, "properties.postalCode")
 
     covidfig.update_geos(fitbounds="locations", visible=False)
     covidfig.update_layout(
         mapbox_style="carto-positron",
         margin={"r":0,"t":0,"l":0,"b":0},
-        height=choroplethHeight,
-        modebar_remove=["pan", "select2d", "lasso2d"])
+        clickmode="select")
 
     return covidfig
 
-def compute_dates(start, end, isRatio):
+def compute_dates(data, start, end, isRatio):
+    # in Ratio view, the months a year earlier are shown as well
     if not isRatio:
-        startDate = datetime.datetime(2019, 1, 1)+relativedelta(months=+start)
-        endDate = datetime.datetime(2019, 1, 1) + relativedelta(months=+end)
-        dates = []
-        while startDate <= endDate:
-            dates.append(startDate)
-            startDate = startDate + relativedelta(months=+1)
-        return dates
+        return data.dates(start, end)
     else:
-        startDate = datetime.datetime(2019, 1, 1)+relativedelta(months=+start)
-        endDate = datetime.datetime(2019, 1, 1) + relativedelta(months=+end)
-        dates = []
-        while startDate <= endDate:
-            dates.append(startDate)
-            startDate = startDate + relativedelta(months=+1)
-        startDate = datetime.datetime(2020, 1, 1)+relativedelta(months=+start)
-        endDate = datetime.datetime(2020, 1, 1) + relativedelta(months=+end)
-        while startDate <= endDate:
-            dates.append(startDate)
-            startDate = startDate + relativedelta(months=+1)
-        return dates
-
-
-def compute_dates_covid(start, end, isRatio):
-    # when not in Ratio view, the slider being completely out of the March-December 2020 range causes the whole range to be shown.
+        return data.dates(start - 12, end - 12) + data.dates(start, end)
+
+
+def compute_dates_covid(data, start, end, isRatio):
+    # when not in Ratio view, the slider being completely out of the covid years causes all of them to be shown.
     # otherwise only the part of the range that's part of the slider will be shown (i.e. March-X 2020)
     if not isRatio:
-        if end <= 12:
-            start = 0
-            end = 11
+        if end <= data.covid_start:
+            start = data.covid_start
+            end = len(data.months) - 1
         else:
-            if start < 12:
-                start = 0
-            else:
-                start = max(0, start%12)
-            end %= 12
-    dates = []
-    startDate = datetime.datetime(2020, 1, 1)+relativedelta(months=+start)
-    endDate = datetime.datetime(2020, 1, 1) + relativedelta(months=+end)
-    while startDate <= endDate:
-        dates.append(startDate)
-        startDate = startDate + relativedelta(months=+1)
-    return dates
-
-
-def get_covid_drilldown(selectedZips, start, end, isRatio):
+            start = max(start, data.covid_start)
+    return data.dates(start, end)
+
+
+@stage("figure")
+def get_covid_drilldown(build, selectedZips, start, end, isRatio):
+    import plotly.express as px
     if (len(selectedZips) == 0):
         return dash.no_update
-    covid_data = []
-    dates = compute_dates_covid(start, end, isRatio)
-    all_dates = compute_dates(start, end, isRatio)
-    for date in dates:
-        df = pd.read_csv(covid_data_path + "covid_data-2020-"+str(date.month)+".csv")
-        df.insert(0, "date", date)
-        covid_data.append(df)
-    all_data = pd.concat(covid_data)
-    location_mask = all_data["zip_code"].isin(selectedZips)
-    covid_drilldown = px.line(all_data[location_mask], x='date', y='hospitalization_rate', line_group = 'zip_code', color='zip_code', hover_name="zip_code", range_x=[min(all_dates), max(all_dates)])
-    events_data = pd.read_csv(covid_data_path + "nyc_events.csv", parse_dates=['date'])
+    data = build_data(build)
+    dates = compute_dates_covid(data, start, end, isRatio)
+    all_dates = compute_dates(data, start, end, isRatio)
+    with stage("aggregation"):
+        if len(selectedZips) > drilldown_series:
+            all_data = data.covidseries.mean(selectedZips, dates)
+            all_data["zip_code"] = "mean of {} zips".format(len(selectedZips))
+        else:
+            all_data = data.covidseries.frame(selectedZips, dates)
+    covid_drilldown = px.line(all_data, x='date', y='hospitalization_rate', line_group = 'zip_code', color='zip_code', hover_name="zip_code", range_x=[min(all_dates), max(all_dates)])
     min_date = min(dates)
     max_date = max(dates)
     
     for idx, row in events_data.iterrows():
-        if row['type'] == "lockdown" or row['type'] == "opening":
-            if row["date"] > min_date and row["date"] < max_date:
-                if row['type'] == "lockdown":
-                    event_color = "red"
-                else:
-                    event_color = "green"
-                covid_drilldown.add_vline(x = row["date"], line_color = event_color)
-                covid_drilldown.add_annotation(x = row["date"], y=1.2, yref='paper', \
-                    showarrow=False, text=row["type"], textangle=-70,font_size=10)
+        if row["date"] > min_date and row["date"] < max_date:
+            if row['type'] == "lockdown":
+                event_color = "red"
+            else:
+                event_color = "green"
+            covid_drilldown.add_vline(x = row["date"], line_color = event_color)
+            covid_drilldown.add_annotation(x = row["date"], y=1.2, yref='paper', \
+                showarrow=False, text=row["type"], textangle=-70,font_size=10)
     return covid_drilldown
         
 
-def get_taxi_drilldown(selectedLocs, start, end, isRatio):
+def drilldown_ranges(data, start, end, isRatio):
+    # (first day, last day) of the months start..end, in Ratio view preceded
+    # by those of the months a year earlier
+    ranges = [data.date_range(start, end)]
+    if isRatio:
+        ranges.insert(0, data.date_range(start - 12, end - 12))
+    return ranges
+
+def has_days(data, start, end, isRatio):
+    # whether the taxi drilldown of the months start..end can show weeks or
+    # days
+    return all(data.taxidays.covers(*dates) for dates in drilldown_ranges(data, start, end, isRatio))
+
+@stage("figure")
+def get_taxi_drilldown(build, selectedLocs, start, end, isRatio, source, granularity="M"):
+    # source: map the selection was made on, the zones of zips selected on
+    # the covid map are compared with each other, up to drilldown_series of
+    # them, the zones selected on the taxi map (or more zones) are summed and
+    # split by taxi type
+    # granularity: "M", or "W"/"D" to roll the daily data up to weeks or days,
+    # if the range has daily data
+    import plotly.express as px
     if (len(selectedLocs) == 0):
         return dash.no_update
-    taxi_zone_data = []
-    dates = compute_dates(start, end, isRatio)
-    for location_id in selectedLocs:
-        df = pd.read_csv(taxi_zone_path + "taxi_data_"+str(location_id)+".csv", parse_dates=['date'])
-        taxi_zone_data.append(df)
-    all_data = pd.concat(taxi_zone_data)
-    mask = all_data['date'].isin(dates)
-
-    taxi_drilldown = None
-    ctx = dash.callback_context
-    if ctx.triggered[0]["prop_id"] == covidTriggerStr:
-        taxi_drilldown = px.bar(all_data[mask], x='date', y='total_cost', barmode='group', color='zone_name')
-    elif ctx.triggered[0]["prop_id"] == taxiTriggerStr:
-        taxi_drilldown = px.bar(all_data[mask], x='date', y='total_cost', barmode='group', color='taxi_type')
-    return taxi_drilldown
-
-# layout
-app.layout = html.Div([
-    html.Div([
-        html.Div([
-            dcc.RangeSlider(
-                id='month-slider',
-                min=2,
-                max=11,
-                step=None,
-                marks=ratio_marks,
-                value= [2, 2],
-        )], className="ten columns"),
-
-        html.Div([
-            html.Button('Ratio view', id='btn-change-view', n_clicks=0),
-        ]),
-    ]),
-
-    html.Div([ 
-        html.Div([
-            html.H1(
-                children='COVID-19 Choropleth',
-                style={
-                    'textAlign': 'center',
-                    'color': 'black'
-                }
-            ),
-            dcc.Graph(id="covid-choropleth")
-        ], className="five columns"),
+    data = build_data(build)
+    byZone = source == "covid" and len(selectedLocs) <= drilldown_series
+    ranges = drilldown_ranges(data, start, end, isRatio)
+    # weeks and days only for ranges that all have daily data, months else
+    daily = granularity != "M" and has_days(data, start, end, isRatio)
+    with stage("aggregation"):
+        if daily:
+            if byZone:
+                all_data = data.taxidays.frame(selectedLocs, ranges, granularity)
+            else:
+                all_data = data.taxidays.total(selectedLocs, ranges, granularity)
+        else:
+            dates = compute_dates(data, start, end, isRatio)
+            if byZone:
+                all_data = data.taxiseries.frame(selectedLocs, dates)
+            else:
+                all_data = data.taxiseries.total(selectedLocs, dates)
 
-        html.Div([
-            html.H1(
-                children='Taxi Choropleth',
-                style={
-                    'textAlign': 'center',
-                    'color': 'black'
-                }
-            ),
-            dcc.Graph(id="taxi-choropleth")
-        ], className="five columns"),
+    if byZone:
+        taxi_drilldown = px.bar(all_data, x='date', y='total_cost', barmode='group', color='zone_name')
+    else:
+        taxi_drilldown = px.bar(all_data, x='date', y='total_cost', barmode='group', color='taxi_type')
+    if granularity != "M" and not daily:
+        # weeks or days were asked for
+        dayMonths = sorted(data.taxidays.months)
+        if dayMonths:
+            first, last = [month_labels[month.month - 1] + " " + str(month.year)
+                           for month in (dayMonths[0], dayMonths[-1])]
+            title = "Months, the daily data only covers {} to {}".format(first, last)
+        else:
+            title = "Months, there is no daily data"
+        taxi_drilldown.update_layout(title=title)
+    return taxi_drilldown
 
+def granularity_options(hasDays):
+    # options of the taxi drilldown, weeks and days if the store has daily data
+    return [{"label": "Months", "value": "M"},
+            {"label": "Weeks", "value": "W", "disabled": not hasDays},
+            {"label": "Days", "value": "D", "disabled": not hasDays}]
+
+# layout, built for each page load from the current data. Dash also builds
+# it once when it is set, outside of any request, only to validate the
+# callbacks against its components, which does not load the data
+def serve_layout():
+    if flask.has_request_context():
+        data = current_data()
+        sliderMin, sliderMax, sliderMarks, sliderValue = slider_view(data, False)
+        build, hasDays = data.build, len(data.taxidays) > 0
+    else:
+        sliderMin, sliderMax, sliderMarks, sliderValue = 0, 0, {}, [0, 0]
+        build, hasDays = None, False
+    return html.Div([
         html.Div([
-            html.Button('Bivariate View', id='btn-bu-change-view', n_clicks=0),
+            html.Div([
+                dcc.RangeSlider(
+                    id='month-slider',
+                    min=sliderMin,
+                    max=sliderMax,
+                    step=None,
+                    marks=sliderMarks,
+                    value=sliderValue,
+            )], className="ten columns"),
+
+            html.Div([
+                html.Button('Ratio view', id='btn-change-view', n_clicks=0),
+            ]),
         ]),
 
-        html.Div([
-            dcc.Graph(id="taxi-legend")
-        ], className="one column")
-    ], className="row"),
-
-    html.Div([ 
-        html.Div([
-            html.H1(
-                children='COVID-19 Drilldown',
-                style={
-                    'textAlign': 'center',
-                    'color': 'black'
-                }
-            ),
-            dcc.Graph(id='covid-drilldown'),
-        ], className="five columns"),
-
-        html.Div([
-            html.H1(
-                children='Taxi Drilldown',
-                style={
-                    'textAlign': 'center',
-                    'color': 'black'
-                }
-            ),
-            dcc.Graph(id='taxi-drilldown'),
-        ], className="five columns"),
-    ], className="row", id="drilldown", style= {'display': 'block'}),
-
-    dcc.Store("current-taxidf"),
-    dcc.Store("current-coviddf"),
-    dcc.Store("is-bivariate-view"),
-    dcc.Store("is-ratio-view"),
-    dcc.Store("current-hover-formatting"),
-    dcc.Store("current-coloring")
-])
+        html.Div([ 
+            html.Div([
+                html.H1(
+                    children='COVID-19 Choropleth',
+                    style={
+                        'textAlign': 'center',
+                        'color': 'black'
+                    }
+                ),
+                dcc.Graph(id="covid-choropleth", style={"height": choroplethHeight})
+            ], className="five columns"),
+
+            html.Div([
+                html.H1(
+                    children='Taxi Choropleth',
+                    style={
+                        'textAlign': 'center',
+                        'color': 'black'
+                    }
+                ),
+                dcc.Graph(id="taxi-choropleth", style={"height": choroplethHeight})
+            ], className="five columns"),
+
+            html.Div([
+                html.Button('Bivariate View', id='btn-bu-change-view', n_clicks=0),
+            ]),
+
+            html.Div([
+                dcc.Graph(id="taxi-legend", style={"height": legendSize, "width": legendSize})
+            ], className="one column")
+        ], className="row"),
+
+        html.Div([ 
+            html.Div([
+                html.H1(
+                    children='COVID-19 Drilldown',
+                    style={
+                        'textAlign': 'center',
+                        'color': 'black'
+                    }
+                ),
+                dcc.Graph(id='covid-drilldown'),
+            ], className="five columns"),
+
+            html.Div([
+                html.H1(
+                    children='Taxi Drilldown',
+                    style={
+                        'textAlign': 'center',
+                        'color': 'black'
+                    }
+                ),
+                dcc.RadioItems(
+                    id='drilldown-granularity',
+                    options=granularity_options(hasDays),
+                    value="M",
+                    labelStyle={'display': 'inline-block'}
+                ),
+                dcc.Graph(id='taxi-drilldown'),
+            ], className="five columns"),
+        ], className="row", id="drilldown", style= {'display': 'block'}),
+
+        dcc.Store("taxi-choropleth-data"),
+        dcc.Store("covid-choropleth-data"),
+        dcc.Store("covid-drilldown-data"),
+        dcc.Store("taxi-drilldown-data"),
+        dcc.Store("map-viewport"),
+        dcc.Store("current-selection"),
+        dcc.Store("current-taxidf"),
+        dcc.Store("current-coviddf"),
+        dcc.Store("is-bivariate-view"),
+        dcc.Store("is-ratio-view"),
+        dcc.Store("data-build", data=build),
+        # identifies the page to the drilldown jobs
+        dcc.Store("client-id", data=uuid.uuid4().hex),
+        dcc.Interval(id="drilldown-poll", interval=drilldown_poll, disabled=True),
+        dcc.Interval(id="data-refresh", interval=refresh_interval * 1000)
+    ])
+
+app.layout = serve_layout
 
 # interactions
-covidTriggerStr = "covid-choropleth.clickData"
-taxiTriggerStr = "taxi-choropleth.clickData"
-covidRelayoutStr = "covid-choropleth.relayoutData"
-taxiRelayoutStr = "taxi-choropleth.relayoutData"
+covidTriggerStr = "covid-choropleth.selectedData"
+taxiTriggerStr = "taxi-choropleth.selectedData"
+
+# a new build of the store is passed on to the page, which updates the
+# slider, maps and drilldown granularities
+@app.callback(
+    Output("data-build", "data"),
+    [Input("data-refresh", "n_intervals")],
+    [State("data-build", "data")])
+@timed
+def update_data_build(n_intervals, build):
+    data = current_data()
+    if data.build == build:
+        return dash.no_update
+    return data.build
 
 @app.callback([
     Output("btn-change-view", "children"),
@@ -537,12 +639,29 @@ taxiRelayoutStr = "taxi-choropleth.relayoutData"
     Output("month-slider", "value"),
 ], [
     Input("btn-change-view", "n_clicks"),
+    Input("data-build", "data"),
+], [
+    State("month-slider", "value"),
 ])
-def update_slider_view(n_clicks):
-    if (n_clicks % 2):
-        return "Raw Revenue View", True, 2, 11, ratio_marks, [2, 2]
+@timed
+def update_slider_view(n_clicks, build, value):
+    isRatioView = bool(n_clicks % 2)
+    sliderMin, sliderMax, sliderMarks, sliderValue = slider_view(current_data(), isRatioView)
+    # new data keeps the selected range
+    if dash.callback_context.triggered[0]["prop_id"] == "data-build.data" and value:
+        sliderValue = [min(max(v, sliderMin), sliderMax) for v in value]
+    if isRatioView:
+        return "Raw Revenue View", True, sliderMin, sliderMax, sliderMarks, sliderValue
     else:
-        return "Ratio View", False, 0, 23, rawrevenue_marks, [12, 12]
+        return "Ratio View", False, sliderMin, sliderMax, sliderMarks, sliderValue
+
+@app.callback(
+    Output("drilldown-granularity", "options"),
+    [Input("data-build", "data")],
+    prevent_initial_call=True)
+@timed
+def update_granularity_options(build):
+    return granularity_options(len(current_data().taxidays) > 0)
 
 @app.callback([
     Output("btn-bu-change-view", "children"),
@@ -550,84 +669,48 @@ def update_slider_view(n_clicks):
 ], [
     Input("btn-bu-change-view", "n_clicks"),
 ])
+@timed
 def update_bivariate_view(n_clicks):
     if (n_clicks % 2):
         return "Univariate View", True
     else:
         return "Bivariate View", False
 
-@app.callback([
-    Output("current-coviddf", "data"),
-    Output("current-taxidf", "data"),
-    Output("current-hover-formatting", "data"),
-    Output("current-coloring", "data")],
-    [Input("month-slider", "value"),
-    Input("is-ratio-view", "data"),
-    Input("is-bivariate-view", "data")])
-def update_current_dataframe(value, isRatioView, isBivariateView):
-    # print("isRatioView is:", isRatioView)
-    # print("isBivariateView is:", isBivariateView)
-    start, end = value
-
+# frames of the current slider range, kept server-side: the current-coviddf
+# and current-taxidf stores only carry the key (build, start, end,
+# isRatioView) the frames are computed from, so that an evicted frame or one
+# computed by another worker is recomputed from its key, and frames of an
+# older build of the store are not reused
+current_frames = TieredCache(LRUCache(maxsize=128),
+                             FileCache(os.path.join(cache_path, "frames"), maxbytes=128 * 2**20))
+
+@memoize(current_frames)
+@stage("aggregation")
+def get_current_taxidf(build, start, end, isRatioView):
+    data = build_data(build)
+    nmonths = end - start + 1
+    if isRatioView:
+        # compared with the same months a year earlier
+        yellowBefore, greenBefore = data.taxicube.range_sum(start - 12, end - 12)
+        yellow, green = data.taxicube.range_sum(start, end)
+        return data.taxi_attributes.assign(**ratio_columns(yellowBefore, greenBefore,
+                                                        yellow, green,
+                                                        nmonths, biv_colors))
+    else:
+        yellow, green = data.taxicube.range_sum(start, end)
+        return data.taxi_attributes.assign(**amount_columns(yellow, green, biv_colors))
+
+@memoize(current_frames)
+@stage("aggregation")
+def get_current_coviddf(build, start, end, isRatioView):
+    data = build_data(build)
+    # months before the covid data have a hospitalization rate of 0
+    rate = data.covidcube.range_mean(start, end)
+    return pd.DataFrame({"zip_code": data.covid_zips, "hospitalization_rate": rate})
+
+def get_view_formatting(isRatioView, isBivariateView):
+    # hover formatting and coloring column of the taxi choropleth
     if isRatioView:
-        if start == end:
-            print(len(taxidfMonths))
-            print(end)
-            tdf = taxidfMonths[12 + end].copy()
-            tdf.drop(columns=["biv_amount_color"], inplace=True)
-
-            cdf = coviddfMonths[end].copy()
-        else:
-            tdf2020 = taxidfMonths[12 + end].copy()
-            tdf2019 = taxidfMonths[end].copy()
-            for i in range(start, end):
-                tdf2020["yellow_total_amount"] += taxidfMonths[12 + i]["yellow_total_amount"]
-                tdf2020["green_total_amount"] += taxidfMonths[12 + i]["green_total_amount"]
-                tdf2019["yellow_total_amount"] += taxidfMonths[i]["yellow_total_amount"]
-                tdf2019["green_total_amount"] += taxidfMonths[i]["green_total_amount"]
-            yellowratio = pd.DataFrame({"ratio":\
-                (tdf2019["yellow_total_amount"] - tdf2020["yellow_total_amount"]) \
-                            / tdf2019["yellow_total_amount"]}).replace([np.nan, np.inf, -np.inf], 0) \
-                                / (end - start + 1)
-            greenratio = pd.DataFrame({"ratio":\
-                (tdf2019["green_total_amount"] - tdf2020["green_total_amount"]) \
-                            / tdf2019["green_total_amount"]}).replace([np.nan, np.inf, -np.inf], 0) \
-                                / (end - start + 1)
-            totalratio = pd.DataFrame({"ratio":\
-              (tdf2019["green_total_amount"] - tdf2020["green_total_amount"] \
-                   + tdf2019["yellow_total_amount"] - tdf2020["yellow_total_amount"]) \
-                            / (tdf2019["green_total_amount"]+tdf2019["yellow_total_amount"])}).replace([np.nan, np.inf, -np.inf], 0) \
-                                / (end - start + 1)
-
-            yellow_percentiles = np.percentile(yellowratio["ratio"], [33, 66])
-            green_percentiles = np.percentile(greenratio["ratio"], [33, 66])
-            colors = data2color( yellowratio["ratio"],
-                                    greenratio["ratio"],
-                                    a=yellow_percentiles[0],  b=yellow_percentiles[1], 
-                                    c=green_percentiles[0],  d=green_percentiles[1],
-                                    biv_colors=biv_colors)
-            tdf2020["yellow_change_percent"] = -yellowratio["ratio"] * 100
-            tdf2020["green_change_percent"] = -greenratio["ratio"] * 100
-            tdf2020["total_change_percent"] = -totalratio["ratio"]*100
-            tdf2020["biv_ratio_color"] = colors
-            
-            tdf = tdf2020
-            tdf.drop(columns=["biv_amount_color"], inplace=True)
-            tdf['total_amount'] =  tdf["yellow_total_amount"]+tdf["green_total_amount"]
-            tdf["log_total_amount"] = \
-                np.array(list(map(myLog, tdf["total_amount"])))
-            tdf["log_total_change_percent"] = \
-                np.array(list(map(myLog, tdf["total_change_percent"])))
-            tdf["sigmoid_total_change_percent"] = \
-                np.array(list(map(sigmoid, tdf["total_change_percent"])))
-            tdf["newlog_total_change_percent"] = \
-                np.array(list(map(newLog, tdf["total_change_percent"])))
-
-            cdf = coviddfMonths[end].copy()
-            for i in range(start, end):
-                cdf["hospitalization_rate"] += coviddfMonths[i]["hospitalization_rate"]
-            cdf["hospitalization_rate"] /= (end - start + 1)
-
         hover_data = {"yellow_total_amount": ":.2f",
                         "green_total_amount" : ":.2f",
                         "log_total_amount": ":.2f",
@@ -644,58 +727,6 @@ def update_current_dataframe(value, isRatioView, isBivariateView):
             coloring = "newlog_total_change_percent"
 
     else:
-        if start == end:
-            tdf = taxidfMonths[end].copy()
-            if (end >= 12):
-                # 2020
-                tdf.drop(columns=["yellow_change_percent", \
-                                    "green_change_percent", \
-                                    "biv_ratio_color"], inplace=True)
-
-                cdf = coviddfMonths[end - 12].copy()
-            else:
-                # 2019
-                cdf = coviddfMonths[0].copy()
-                cdf["hospitalization_rate"] = 0
-        else:
-            tdf = taxidfMonths[end].copy()
-            for i in range(start, end):
-                tdf["yellow_total_amount"] += taxidfMonths[i]["yellow_total_amount"]
-                tdf["green_total_amount"] += taxidfMonths[i]["green_total_amount"]
-            tdf["yellow_log_total_amount"] = \
-                np.array(list(map(myLog, tdf["yellow_total_amount"])))
-            tdf["green_log_total_amount"] = \
-                np.array(list(map(myLog, tdf["green_total_amount"])))
-            yellow_percentiles = np.percentile(tdf["yellow_log_total_amount"], [33, 66])
-            green_percentiles = np.percentile(tdf["green_log_total_amount"], [33, 66])
-            colors = data2color(tdf["yellow_log_total_amount"],
-                                tdf["green_log_total_amount"],
-                                a=yellow_percentiles[0],  b=yellow_percentiles[1], 
-                                c=green_percentiles[0],  d=green_percentiles[1],
-                                biv_colors=biv_colors)
-            tdf["biv_amount_color"] = colors
-            tdf.drop(columns=["yellow_log_total_amount", "green_log_total_amount"], inplace=True)
-            tdf['total_amount'] =  tdf["yellow_total_amount"]+tdf["green_total_amount"]
-            tdf["log_total_amount"] = \
-                np.array(list(map(myLog, tdf["total_amount"])))
-            if (end >= 12):
-                # 2020
-                tdf.drop(columns=["yellow_change_percent", \
-                                    "green_change_percent", \
-                                    "total_change_percent", \
-                                    "biv_ratio_color"], inplace=True)
-
-                cdf = coviddfMonths[end - 12].copy()
-            else:
-                # 2019
-                cdf = coviddfMonths[0].copy()
-                cdf["hospitalization_rate"] = 0
-
-            for i in range(start, end):
-                if i >= 12:
-                    cdf["hospitalization_rate"] += coviddfMonths[i - 12]["hospitalization_rate"]
-            cdf["hospitalization_rate"] /= (end - start + 1)
-
         hover_data = {"yellow_total_amount": ":.2f",
                         "green_total_amount" : ":.2f",
                         "log_total_amount" : ":.2f",
@@ -706,119 +737,317 @@ def update_current_dataframe(value, isRatioView, isBivariateView):
         if not isBivariateView:
             coloring = "log_total_amount"
 
-    return cdf.to_json(), tdf.to_json(), hover_data, coloring
+    return hover_data, coloring
+
+# fully built choropleths keyed by the slider range, the views and the
+# selection. They are cached and sent without their geometry: the browser
+# keeps the geometry it fetched resident and puts it back into the traces
+# (see assets/choropleth.js), or draws the vector tiles of tiled_figure, so
+# an update only carries the per-zone arrays, encoded as typed arrays (see
+# encoding.py)
+choropleth_figures = TieredCache(LRUCache(maxsize=256),
+                                 FileCache(os.path.join(cache_path, "tiled-figures" if vector_tiles else "figures"),
+                                           maxbytes=256 * 2**20))
+
+def geometry_free(fig):
+    # fig as a dict whose traces do not hold their geojson
+    figure = fig.to_dict()
+    for trace in figure["data"]:
+        trace.pop("geojson", None)
+    return figure
+
+# source layer of the vector tiles
+tile_layer = "boundaries"
+
+def tile_source(mapID, locations):
+    # tile url of the boundaries of the given locations
+    return ["/tiles/{}/{{z}}/{{x}}/{{y}}.pbf?ids={}".format(
+        mapID, ",".join(str(location) for location in sorted(set(locations))))]
+
+@stage("figure")
+def tiled_figure(figure, mapID, build):
+    # figure, without geometry, drawn from the vector tiles of mapID: the
+    # locations of each color of the choropleth traces are filled by a tile
+    # layer, the selected ones outlined, and each trace is replaced by
+    # transparent markers on the locations that keep its hover, clicks and
+    # selection, the location and z values being moved to the end of its
+    # customdata
+    from plotly.colors import sample_colorscale
+
+    points = build_data(build).tiles[mapID].points
+    layout = figure["layout"]
+    colorscale = layout.get("coloraxis", {}).get("colorscale")
+    zs = np.concatenate([np.asarray(trace["z"], dtype=np.float64)
+                         for trace in figure["data"] if trace.get("coloraxis")] or [np.zeros(0)])
+    zmin, zmax = (zs.min(), zs.max()) if len(zs) else (0, 1)
+    layers = []
+    data = []
+    for trace in figure["data"]:
+        marker = trace.get("marker", {})
+        locations = np.asarray(trace["locations"])
+        z = np.asarray(trace["z"], dtype=np.float64)
+        opacity = marker.get("opacity", 1)
+        if "line" in marker:
+            layers.append({"sourcetype": "vector", "source": tile_source(mapID, locations),
+                           "sourcelayer": tile_layer, "type": "line",
+                           "color": marker["line"]["color"], "line": {"width": marker["line"]["width"]}})
+        elif trace.get("coloraxis"):
+            classes = np.clip(((z - zmin) / ((zmax - zmin) or 1) * tile_classes).astype(int),
+                              0, tile_classes - 1)
+            colors = sample_colorscale(colorscale, list((np.arange(tile_classes) + 0.5) / tile_classes))
+            for c in np.unique(classes):
+                layers.append({"sourcetype": "vector", "source": tile_source(mapID, locations[classes == c]),
+                               "sourcelayer": tile_layer, "type": "fill",
+                               "color": colors[c], "opacity": opacity})
+        else:
+            layers.append({"sourcetype": "vector", "source": tile_source(mapID, locations),
+                           "sourcelayer": tile_layer, "type": "fill",
+                           "color": trace["colorscale"][0][1], "opacity": opacity})
+        if trace.get("hoverinfo") == "skip":
+            continue
+
+        locations = locations.tolist()
+        drawn = [i for i, location in enumerate(locations) if location in points]
+        customdata = trace.get("customdata")
+        ncolumns = len(customdata[0]) if customdata is not None and len(customdata) else 0
+        hovertemplate = trace["hovertemplate"].replace(
+            "%{location", "%{customdata[" + str(ncolumns + 1) + "]").replace(
+            "%{z", "%{customdata[" + str(ncolumns) + "]")
+        data.append({
+            "type": "scattermapbox", "subplot": trace["subplot"], "name": trace["name"],
+            "showlegend": False, "mode": "markers",
+            "lon": [points[locations[i]][0] for i in drawn],
+            "lat": [points[locations[i]][1] for i in drawn],
+            "marker": dict({"size": 20, "opacity": 0},
+                           **({"color": z[drawn], "coloraxis": trace["coloraxis"]}
+                              if trace.get("coloraxis") else {})),
+            "hovertext": [trace["hovertext"][i] for i in drawn],
+            "customdata": [(list(customdata[i]) if ncolumns else []) + [float(z[i]), locations[i]]
+                           for i in drawn],
+            "hovertemplate": hovertemplate})
+        if "selectedpoints" in trace:
+            selected = set(trace["selectedpoints"])
+            data[-1]["selectedpoints"] = [j for j, i in enumerate(drawn) if i in selected]
+    layout["mapbox"] = dict(layout["mapbox"], layers=layers)
+    return {"data": data, "layout": layout}
+
+def selected_locations(selectedData):
+    # locations of the selected zones, sorted, from the choropleth traces or
+    # the markers of tiled_figure
+    points = selectedData["points"] if selectedData else []
+    return sorted({point["location"] if "location" in point else point["customdata"][-1]
+                   for point in points})
+
+@memoize(choropleth_figures)
+def get_cached_taxifig(build, start, end, isRatioView, isBivariateView, selectedLocs):
+    hover_data, coloring = get_view_formatting(isRatioView, isBivariateView)
+    taxifig = get_taxifig(list(selectedLocs), get_current_taxidf(build, start, end, isRatioView),
+                            hover_data, coloring, isBivariateView, defaultCenter, defaultZoom)
+    if build_data(build).tiles:
+        return encode_figure(tiled_figure(geometry_free(taxifig), "taxi-choropleth", build))
+    return encode_figure(geometry_free(taxifig))
+
+@memoize(choropleth_figures)
+def get_cached_covidfig(build, start, end, isRatioView, selectedZips):
+    covidfig = get_covidfig(list(selectedZips), get_current_coviddf(build, start, end, isRatioView),
+                            defaultCenter, defaultZoom)
+    if build_data(build).tiles:
+        return encode_figure(tiled_figure(geometry_free(covidfig), "covid-choropleth", build))
+    return encode_figure(geometry_free(covidfig))
+
+def warm_figure_cache():
+    # pre-renders the single-month states of every view, without selection,
+    # starting with the initial raw revenue view
+    data = current_data()
+    nmonths = len(data.months)
+    for isRatioView, months in ((False, range(data.covid_start, nmonths)),
+                                (False, range(0, data.covid_start)),
+                                (True, range(data.ratio_start, nmonths))):
+        for month in months:
+            for isBivariateView in (False, True):
+                get_cached_taxifig(data.build, month, month, isRatioView, isBivariateView, ())
+            get_cached_covidfig(data.build, month, month, isRatioView, ())
 
 @app.callback([
-    Output("covid-choropleth", "figure"),
-    Output("taxi-choropleth", "figure"),
-], [
-    Input("covid-choropleth", "clickData"),
-    Input("taxi-choropleth", "clickData"),
+    Output("current-coviddf", "data"),
+    Output("current-taxidf", "data")],
+    [Input("month-slider", "value"),
+    Input("is-ratio-view", "data"),
+    Input("data-build", "data")])
+@timed
+def update_current_dataframe(value, isRatioView, build):
+    start, end = value
+    key = [current_data().build, start, end, bool(isRatioView)]
+    return key, key
+
+@app.callback(
+    Output("current-selection", "data"),
+[
+    Input("covid-choropleth", "selectedData"),
+    Input("taxi-choropleth", "selectedData"),
+])
+@timed
+def update_selection(covidSelectedData, taxiSelectedData):
+    # zips and taxi zones of the last selection on either map, with the map
+    # it was made on as source, deselecting clears it
+    ctx = dash.callback_context
+
+    # figure out which map triggered the callback
+    if ctx.triggered[0]["prop_id"] == covidTriggerStr:
+        covidLocations = selected_locations(covidSelectedData)
+        if not covidLocations:
+            return None
+        return {"source": "covid", "zips": covidLocations,
+                "locs": sorted(overlap.zones_for_zips(covidLocations))}
+    elif ctx.triggered[0]["prop_id"] == taxiTriggerStr:
+        taxiLocations = selected_locations(taxiSelectedData)
+        if not taxiLocations:
+            return None
+        return {"source": "taxi", "zips": sorted(overlap.zips_for_zones(taxiLocations)),
+                "locs": taxiLocations}
+    return dash.no_update
+
+# each map only rebuilds on the inputs it depends on
+@app.callback(
+    Output("covid-choropleth-data", "data"),
+[
     Input("current-coviddf", "data"),
+    Input("current-selection", "data"),
+])
+@timed
+def update_covidplot(cdf, selection):
+    selectedZips = selection["zips"] if selection else []
+    return get_cached_covidfig(*cdf, tuple(selectedZips))
+
+@app.callback(
+    Output("taxi-choropleth-data", "data"),
+[
     Input("current-taxidf", "data"),
-    Input("current-hover-formatting", "data"),
-    Input("current-coloring", "data"),
     Input("is-bivariate-view", "data"),
-    Input('covid-choropleth', 'relayoutData'),
-    Input('taxi-choropleth', 'relayoutData')
-], [
-    State('covid-choropleth', 'figure'),
-    State('taxi-choropleth', 'figure')
+    Input("current-selection", "data"),
 ])
-def update_plots(covidClickData, taxiClickData, cdf, tdf, hover_data, coloring, isBivariateView, covidRelayout, taxiRelayout, covidFig, taxiFig):
-    ctx = dash.callback_context
-    #ctx_msg = json.dumps({
-    #    'states': ctx.states,
-    #    'triggered': ctx.triggered,
-    #    'inputs': ctx.inputs
-    #}, indent=2)
-    taxidata = pd.DataFrame.from_dict(json.loads(tdf))
-    coviddata = pd.DataFrame.from_dict(json.loads(cdf))
-
-    # vars to be filled in
-    covidLocation = None
-    taxiLocation = None
-    selectedZips = []
-    selectedLocs = []
-
-    currCenter = defaultCenter
-    currZoom = defaultZoom
-
-    if (covidFig is not None):
-        # figure out which map triggered the callback
-        if ctx.triggered[0]["prop_id"] == covidTriggerStr:
-            if covidClickData is not None:
-                covidLocation = covidClickData["points"][0]["location"]
-        elif ctx.triggered[0]["prop_id"] == taxiTriggerStr:
-            if taxiClickData is not None:
-                taxiLocation = taxiClickData["points"][0]["location"]
-        elif ctx.triggered[0]["prop_id"] == covidRelayoutStr:
-            if covidRelayout is not None and "mapbox.center" in covidRelayout:
-                taxiFig["layout"]["mapbox"]["center"] = covidRelayout["mapbox.center"]
-                taxiFig["layout"]["mapbox"]["zoom"] = covidRelayout["mapbox.zoom"]
-                return covidFig, taxiFig
-        elif ctx.triggered[0]["prop_id"] == taxiRelayoutStr:
-            if taxiRelayout is not None and "mapbox.center" in taxiRelayout:
-                covidFig["layout"]["mapbox"]["center"] = taxiRelayout["mapbox.center"]
-                covidFig["layout"]["mapbox"]["zoom"] = taxiRelayout["mapbox.zoom"]
-                return covidFig, taxiFig
-
-        if covidLocation:
-            selectedZips = [covidLocation]
-            selectedLocs = list(overlapdf[overlapdf["zip_code"] == covidLocation]["LocationID"])
-        elif taxiLocation:
-            selectedLocs = [taxiLocation]
-            selectedZips = list(overlapdf[overlapdf["LocationID"] == taxiLocation]["zip_code"])
-
-        currCenter = covidFig["layout"]["mapbox"]["center"]
-        currZoom = covidFig["layout"]["mapbox"]["zoom"]
-
-    return get_covidfig(selectedZips, coviddata, currCenter, currZoom), \
-            get_taxifig(selectedLocs, taxidata, hover_data, coloring, isBivariateView, currCenter, currZoom)
-
+@timed
+def update_taxiplot(tdf, isBivariateView, selection):
+    selectedLocs = selection["locs"] if selection else []
+    return get_cached_taxifig(*tdf, bool(isBivariateView), tuple(selectedLocs))
+
+# pan/zoom sync between the two maps, entirely in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace="choropleth", function_name="viewport"),
+    Output("map-viewport", "data"),
+    [Input("covid-choropleth", "relayoutData"),
+    Input("taxi-choropleth", "relayoutData")])
+
+for mapID in ["covid-choropleth", "taxi-choropleth"]:
+    app.clientside_callback(
+        ClientsideFunction(namespace="choropleth", function_name="render"),
+        Output(mapID, "figure"),
+        [Input(mapID + "-data", "data"),
+        Input("map-viewport", "data")],
+        [State(mapID, "id"),
+        State(mapID, "figure")])
+
+# drilldowns of a selection and slider range
+drilldown_figures = TieredCache(LRUCache(maxsize=128),
+                                FileCache(os.path.join(cache_path, "drilldowns"), maxbytes=128 * 2**20))
+
+@memoize(drilldown_figures)
+def get_cached_covid_drilldown(build, selectedZips, start, end, isRatio):
+    return encode_figure(get_covid_drilldown(build, list(selectedZips), start, end, isRatio).to_dict())
+
+@memoize(drilldown_figures)
+def get_cached_taxi_drilldown(build, selectedLocs, start, end, isRatio, source, granularity):
+    return encode_figure(get_taxi_drilldown(build, list(selectedLocs), start, end, isRatio,
+                                            source, granularity).to_dict())
+
+# the drilldowns are built by background jobs, so that a selection or slider
+# change never holds a worker while the maps repaint: the callback submits
+# the job of the current inputs, which cancels the stale job of the page,
+# and polls until the job has put both figures in the cache. Another worker
+# process that gets the poll joins the job or runs it too
+drilldown_jobs = JobQueue(drilldown_workers)
+
+def drilldown_job(selection, value, isRatio, granularity):
+    # arguments of the drilldowns of a selection and slider range. A single
+    # month is shown in the full range of its view, except by the taxi
+    # drilldown if it has the weeks or days of that month
+    data = current_data()
+    start, end = value
+    taxiStart, taxiEnd = start, end
+    if start == end:
+        start = data.covid_start if isRatio else 0
+        end = len(data.months) - 1
+        if granularity == "M" or not has_days(data, taxiStart, taxiEnd, isRatio):
+            taxiStart, taxiEnd = start, end
+    return (data.build, tuple(selection["zips"]), tuple(selection["locs"]), start, end,
+            taxiStart, taxiEnd, bool(isRatio), selection["source"], granularity)
+
+def run_drilldown_job(job):
+    # builds the figures of a job into the cache, the taxi one only if the
+    # job is still wanted, timed as a drilldown_job at /metrics
+    build, zips, locs, start, end, taxiStart, taxiEnd, isRatio, source, granularity = job
+    with timed_job(callback_metrics, "drilldown_job"):
+        if zips:
+            get_cached_covid_drilldown(build, zips, start, end, isRatio)
+        if locs and not drilldown_jobs.cancelled(job):
+            get_cached_taxi_drilldown(build, locs, taxiStart, taxiEnd, isRatio, source, granularity)
+
+def cached_drilldowns(job):
+    # figures of a job if both are cached, else None
+    build, zips, locs, start, end, taxiStart, taxiEnd, isRatio, source, granularity = job
+    if zips and not get_cached_covid_drilldown.cached(build, zips, start, end, isRatio):
+        return None
+    if locs and not get_cached_taxi_drilldown.cached(build, locs, taxiStart, taxiEnd, isRatio,
+                                                     source, granularity):
+        return None
+    return (get_cached_covid_drilldown(build, zips, start, end, isRatio) if zips else dash.no_update,
+            get_cached_taxi_drilldown(build, locs, taxiStart, taxiEnd, isRatio, source, granularity)
+            if locs else dash.no_update)
 
 @app.callback([
-    Output("covid-drilldown", "figure"),
-    Output("taxi-drilldown", "figure"),
+    Output("covid-drilldown-data", "data"),
+    Output("taxi-drilldown-data", "data"),
+    Output("drilldown-poll", "disabled"),
 ], [
-    Input("covid-choropleth", "clickData"),
-    Input("taxi-choropleth", "clickData"),
+    Input("current-selection", "data"),
     Input("month-slider", "value"),
     Input("is-ratio-view", "data"),
+    Input("drilldown-granularity", "value"),
+    Input("drilldown-poll", "n_intervals"),
+], [
+    State("client-id", "data"),
 ])
-def update_drilldowns(covidClickData, taxiClickData, value, isRatio):
-    ctx = dash.callback_context
-
-    start, end = value
-    if start == end and isRatio:
-        start = 0
-        end = 11
-    if start == end and not isRatio:
-        start = 0
-        end = 23
-
-    # vars to be filled in
-    covidLocation = None
-    taxiLocation = None
-    selectedZips = []
-    selectedLocs = []
-
-    # figure out which map triggered the callback
-    if ctx.triggered[0]["prop_id"] == covidTriggerStr:
-        if covidClickData is not None:
-            covidLocation = covidClickData["points"][0]["location"]
-    elif ctx.triggered[0]["prop_id"] == taxiTriggerStr:
-        if taxiClickData is not None:
-            taxiLocation = taxiClickData["points"][0]["location"]
-
-    if covidLocation:
-        selectedZips = [covidLocation]
-        selectedLocs = list(overlapdf[overlapdf["zip_code"] == covidLocation]["LocationID"])
-    elif taxiLocation:
-        selectedLocs = [taxiLocation]
-        selectedZips = list(overlapdf[overlapdf["LocationID"] == taxiLocation]["zip_code"])
-
-    return get_covid_drilldown(selectedZips, start, end, isRatio), get_taxi_drilldown(selectedLocs, start, end, isRatio)
+@timed
+def update_drilldowns(selection, value, isRatio, granularity, n_intervals, clientID):
+    if not selection:
+        drilldown_jobs.finish(clientID)
+        return dash.no_update, dash.no_update, True
+
+    job = drilldown_job(selection, value, isRatio, granularity)
+    figures = cached_drilldowns(job)
+    if figures is not None:
+        drilldown_jobs.finish(clientID)
+        return figures + (True,)
+    future = drilldown_jobs.submit(clientID, job, run_drilldown_job, job)
+    if future.done() and not future.cancelled() and future.exception() is not None:
+        app.logger.error("drilldown job failed", exc_info=future.exception())
+        return dash.no_update, dash.no_update, True
+    return dash.no_update, dash.no_update, False
+
+# the drilldown figures are decoded into the graphs in the browser
+for graphID in ["covid-drilldown", "taxi-drilldown"]:
+    app.clientside_callback(
+        ClientsideFunction(namespace="figures", function_name="decode"),
+        Output(graphID, "figure"),
+        [Input(graphID + "-data", "data")])
+
+# timings of the callbacks and hit rates of the caches at /metrics
+callback_metrics = instrument(app, {"frames": current_frames, "figures": choropleth_figures,
+                                    "drilldowns": drilldown_figures})
+
+# pre-render the common states in the background, the app serves meanwhile
+if warmup:
+    threading.Thread(target=warm_figure_cache, daemon=True).start()
 
 # main
 if __name__ == "__main__":
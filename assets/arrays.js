@@ -0,0 +1,64 @@
+// Decoding of the figure arrays encoded by encoding.py: base64 typed arrays,
+// strings sent once with the indexes of their occurrences and 2D arrays sent
+// column by column are turned back into plain arrays, which every plotly.js
+// version draws.
+(function() {
+    var types = {i2: Int16Array, i4: Int32Array, f4: Float32Array, f8: Float64Array};
+    var arrayKeys = ["locations", "z", "customdata", "hovertext", "text", "x", "y", "lat", "lon",
+                     "selectedpoints"];
+    var markerArrayKeys = ["color"];
+
+    function decodeArray(value) {
+        if (!value || typeof value !== "object" || Array.isArray(value) || !value.dtype) {
+            return value;
+        }
+        if (value.dtype === "columns") {
+            var columns = value.columns.map(decodeArray);
+            var rows = [];
+            for (var i = 0; i < columns[0].length; i++) {
+                rows.push(columns.map(function(column) { return column[i]; }));
+            }
+            return rows;
+        }
+        if (value.dtype === "str") {
+            return decodeArray(value.index).map(function(i) { return value.strings[i]; });
+        }
+        var binary = window.atob(value.bdata);
+        var bytes = new Uint8Array(binary.length);
+        for (var j = 0; j < binary.length; j++) {
+            bytes[j] = binary.charCodeAt(j);
+        }
+        return Array.from(new types[value.dtype](bytes.buffer));
+    }
+
+    function decodeTrace(trace) {
+        var decoded = Object.assign({}, trace);
+        arrayKeys.forEach(function(key) {
+            if (key in decoded) {
+                decoded[key] = decodeArray(decoded[key]);
+            }
+        });
+        if (decoded.marker) {
+            decoded.marker = Object.assign({}, decoded.marker);
+            markerArrayKeys.forEach(function(key) {
+                if (key in decoded.marker) {
+                    decoded.marker[key] = decodeArray(decoded.marker[key]);
+                }
+            });
+        }
+        return decoded;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        figures: {
+            // figure with its arrays decoded, used by the choropleths and
+            // as the callback drawing the drilldowns
+            decode: function(figure) {
+                if (!figure) {
+                    return window.dash_clientside.no_update;
+                }
+                return Object.assign({}, figure, {data: figure.data.map(decodeTrace)});
+            }
+        }
+    });
+})();
@@ -0,0 +1,178 @@
+// Client side assembly of the choropleth figures. The server sends the
+// traces without their geojson and with their arrays encoded (decoded by
+// assets/arrays.js), the geometry stays resident in the browser:
+// each map has several levels of detail (window.choroplethGeometryLevels,
+// from the store's /geometry.js), each level is fetched the first time the
+// map is drawn at its zooms and kept. In tile mode (VECTOR_TILES=1) the
+// figures have no choropleth trace but vector tile layers, which are drawn
+// as they are. The viewport follows the map-viewport store, which is also
+// kept on the client so that panning never reaches the server.
+(function() {
+    // map id -> level -> geojson, null while it is being fetched
+    var levels = {};
+    var emptyGeometry = {type: "FeatureCollection", features: []};
+
+    function withViewport(figure, viewport) {
+        var mapbox = Object.assign({}, figure.layout.mapbox,
+                                   {center: viewport.center, zoom: viewport.zoom});
+        return Object.assign({}, figure, {
+            layout: Object.assign({}, figure.layout, {mapbox: mapbox})
+        });
+    }
+
+    function maxzooms(mapID) {
+        return (window.choroplethGeometryLevels || {})[mapID] || [null];
+    }
+
+    function levelAt(mapID, zoom) {
+        var zooms = maxzooms(mapID);
+        for (var i = 0; i < zooms.length - 1; i++) {
+            if (zoom < zooms[i]) {
+                return i;
+            }
+        }
+        return zooms.length - 1;
+    }
+
+    function load(mapID, level) {
+        levels[mapID] = levels[mapID] || {};
+        if (level in levels[mapID]) {
+            return;
+        }
+        levels[mapID][level] = null;
+        fetch("/geometry/" + mapID + "/" + level + ".json")
+            .then(function(response) { return response.json(); })
+            .then(function(geometry) {
+                levels[mapID][level] = geometry;
+                redraw(mapID);
+            })
+            .catch(function() { delete levels[mapID][level]; });
+    }
+
+    // geometry of the level of zoom, fetching it if needed, meanwhile the
+    // closest level already there, or no geometry at all
+    function geometryAt(mapID, zoom) {
+        var level = levelAt(mapID, zoom);
+        load(mapID, level);
+        var loaded = levels[mapID];
+        for (var d = 0; d < 2 * maxzooms(mapID).length; d++) {
+            var i = level + (d % 2 ? (d + 1) / 2 : -d / 2);
+            if (loaded[i]) {
+                return loaded[i];
+            }
+        }
+        return emptyGeometry;
+    }
+
+    // every trace draws from the same geometry, the highlight traces only
+    // color the features of their locations
+    function withGeometry(figure, geometry) {
+        return Object.assign({}, figure, {
+            data: figure.data.map(function(trace) {
+                return Object.assign({}, trace, {geojson: geometry});
+            })
+        });
+    }
+
+    function hasChoropleth(figure) {
+        return figure.data.some(function(trace) { return trace.type === "choroplethmapbox"; });
+    }
+
+    // tile layers with absolute urls, which the map's workers need
+    function withTileUrls(figure) {
+        var layers = (figure.layout.mapbox || {}).layers;
+        if (!layers) {
+            return figure;
+        }
+        var mapbox = Object.assign({}, figure.layout.mapbox, {
+            layers: layers.map(function(layer) {
+                return Object.assign({}, layer, {
+                    source: layer.source.map(function(url) {
+                        return window.location.origin + url;
+                    })
+                });
+            })
+        });
+        return Object.assign({}, figure, {
+            layout: Object.assign({}, figure.layout, {mapbox: mapbox})
+        });
+    }
+
+    function drawnGeometry(figure) {
+        return figure && figure.data && figure.data.length ? figure.data[0].geojson : undefined;
+    }
+
+    // restyles a drawn map whose level arrived after it was drawn, outside
+    // of the callbacks, which use it from the next update on
+    function redraw(mapID) {
+        var graph = document.getElementById(mapID);
+        var plot = graph && graph.getElementsByClassName("js-plotly-plot")[0];
+        if (!plot || !plot.data || !plot.data.length || !plot.layout.mapbox || !window.Plotly) {
+            return;
+        }
+        var geometry = geometryAt(mapID, plot.layout.mapbox.zoom);
+        if (plot.data[0].geojson !== geometry) {
+            window.Plotly.restyle(plot, {geojson: [geometry]});
+        }
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        choropleth: {
+            render: function(update, viewport, mapID, figure) {
+                var no_update = window.dash_clientside.no_update;
+                var triggered = window.dash_clientside.callback_context.triggered.map(
+                    function(t) { return t.prop_id; });
+                var viewportOnly = triggered.every(function(prop_id) {
+                    return prop_id === "map-viewport.data";
+                });
+
+                if (viewportOnly) {
+                    if (!figure || !viewport) {
+                        return no_update;
+                    }
+                    if (!hasChoropleth(figure)) {
+                        return viewport.source === mapID ? no_update : withViewport(figure, viewport);
+                    }
+                    var geometry = geometryAt(mapID, viewport.zoom);
+                    var drawn = drawnGeometry(figure);
+                    var sameLevel = drawn === geometry ||
+                        (drawn && drawn.maxzoom !== undefined && drawn.maxzoom === geometry.maxzoom);
+                    // the map that was panned or zoomed is already there,
+                    // unless it moved to another level of detail
+                    if (viewport.source === mapID && sameLevel) {
+                        return no_update;
+                    }
+                    return withViewport(sameLevel ? figure : withGeometry(figure, geometry), viewport);
+                }
+                if (!update) {
+                    return no_update;
+                }
+                update = window.dash_clientside.figures.decode(update);
+                if (!hasChoropleth(update)) {
+                    var tiled = withTileUrls({data: update.data, layout: update.layout});
+                    return viewport ? withViewport(tiled, viewport) : tiled;
+                }
+                var zoom = viewport ? viewport.zoom : update.layout.mapbox.zoom;
+                var newFigure = withGeometry({data: update.data, layout: update.layout},
+                                             geometryAt(mapID, zoom));
+                return viewport ? withViewport(newFigure, viewport) : newFigure;
+            },
+
+            // center and zoom of the last panned or zoomed map, that the
+            // other map follows
+            viewport: function(covidRelayout, taxiRelayout) {
+                var triggered = window.dash_clientside.callback_context.triggered;
+                var source = triggered.length ? triggered[0].prop_id.split(".")[0] : null;
+                var relayout = source === "covid-choropleth" ? covidRelayout : taxiRelayout;
+                if (!relayout || !("mapbox.center" in relayout)) {
+                    return window.dash_clientside.no_update;
+                }
+                return {
+                    center: relayout["mapbox.center"],
+                    zoom: relayout["mapbox.zoom"],
+                    source: source
+                };
+            }
+        }
+    });
+})();
@@ -0,0 +1,207 @@
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+# Benchmark of the dashboard callbacks and data paths. The callbacks are
+# driven headlessly through the app's own /_dash-update-component endpoint,
+# over representative slider ranges, views and selections, cold (caches
+# cleared before each call) and, for the callbacks with cached results, warm
+# (served from the caches). For each case
+# it reports the latency percentiles, the peak Python memory of a cold call
+# and the size of the response. Results saved with --json can be compared,
+# the comparison exits with 1 when a case got slower by more than the
+# threshold.
+#
+#   python bench.py [-n repeats] [--json results.json]
+#   python bench.py --compare base.json new.json [threshold]
+
+# the app is benchmarked on its own caches, without background warmup
+if "CACHE_PATH" not in os.environ:
+    os.environ["CACHE_PATH"] = tempfile.mkdtemp(prefix="bench-cache-")
+    atexit.register(shutil.rmtree, os.environ["CACHE_PATH"], True)
+os.environ["WARMUP"] = "0"
+
+import app
+from transforms import data2color
+
+repeats = 20
+threshold = 0.1
+percentiles = [50, 90, 99]
+
+def run_callback(client, output, values, triggered):
+    # response of the callback of output, values maps "id.property" to the
+    # value of each input and state, triggered is the changed input
+    callback = app.app.callback_map[output]
+    def props(deps):
+        return [dict(dep, value=values.get(dep["id"] + "." + dep["property"])) for dep in deps]
+    outputs = [{"id": key.split(".")[0], "property": key.split(".")[1]}
+               for key in output.strip(".").split("...")]
+    body = {"output": output, "outputs": outputs if output.startswith("..") else outputs[0],
+            "inputs": props(callback["inputs"]), "state": props(callback["state"]),
+            "changedPropIds": [triggered]}
+    response = client.post("/_dash-update-component", json=body)
+    if response.status_code not in (200, 204):
+        raise RuntimeError("{} failed with {}: {}".format(output, response.status_code,
+                                                          response.data[:200]))
+    return response
+
+def run_drilldowns(client, values):
+    # response of the drilldowns callback with the figures, polling until
+    # their background job is done
+    output = "..covid-drilldown-data.data...taxi-drilldown-data.data...drilldown-poll.disabled.."
+    response = run_callback(client, output, values, "current-selection.data")
+    while "taxi-drilldown-data" not in response.json["response"]:
+        time.sleep(0.001)
+        response = run_callback(client, output, values, "drilldown-poll.n_intervals")
+    return response
+
+def clear_caches():
+    for cache in (app.current_frames, app.choropleth_figures, app.drilldown_figures):
+        cache.clear()
+
+def measure(call, cold):
+    # latencies of repeats calls in seconds, the size of the last result and
+    # the peak memory of a cold call in bytes
+    if not cold:
+        call()
+    latencies = []
+    for _ in range(repeats):
+        if cold:
+            clear_caches()
+        start = time.perf_counter()
+        result = call()
+        latencies.append(time.perf_counter() - start)
+    clear_caches()
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    size = len(result.data) if hasattr(result, "data") else len(json.dumps(result, default=str))
+    return latencies, size, peak
+
+def cases():
+    # ((function, case, cached), call) of every benchmarked case, cached if
+    # its results are kept in the app's caches
+    client = app.app.server.test_client()
+    data = app.current_data()
+    last = len(data.months) - 1
+    ranges = [(False, data.covid_start, data.covid_start), (False, 0, min(11, last)), (False, 0, last),
+              (True, data.ratio_start, data.ratio_start), (True, data.ratio_start, last)]
+    zones = data.taxi_attributes
+    borough = sorted(zones.loc[zones["Borough"] == "Manhattan", "PULocationID"].tolist())
+    selections = {
+        "none": None,
+        "taxi": {"source": "taxi", "zips": app.overlap.zips_for_zones([161]), "locs": [161]},
+        "covid": {"source": "covid", "zips": [10001], "locs": app.overlap.zones_for_zips([10001])},
+        "borough": {"source": "taxi", "zips": sorted(app.overlap.zips_for_zones(borough)), "locs": borough},
+    }
+
+    for isRatio, start, end in ranges:
+        view = "{} {}-{}".format("ratio" if isRatio else "raw", data.months[start], data.months[end])
+        values = {"month-slider.value": [start, end], "is-ratio-view.data": isRatio,
+                  "data-build.data": data.build}
+        yield ("update_current_dataframe", view, False), lambda values=values: run_callback(
+            client, "..current-coviddf.data...current-taxidf.data..", values, "month-slider.value")
+        key = [data.build, start, end, isRatio]
+        for selection, selected in selections.items():
+            values = {"current-coviddf.data": key, "current-taxidf.data": key,
+                      "current-selection.data": selected}
+            yield ("update_covidplot", view + " sel=" + selection, True), lambda values=values: run_callback(
+                client, "covid-choropleth-data.data", values, "current-coviddf.data")
+            for isBivariate in (False, True):
+                values = dict(values, **{"is-bivariate-view.data": isBivariate})
+                yield ("update_taxiplot", view + " sel={} biv={}".format(selection, isBivariate), True), \
+                    lambda values=values: run_callback(client, "taxi-choropleth-data.data", values,
+                                                       "current-taxidf.data")
+            if selected is None:
+                continue
+            for granularity in ("M", "W", "D"):
+                values = {"current-selection.data": selected, "month-slider.value": [start, end],
+                          "is-ratio-view.data": isRatio, "drilldown-granularity.value": granularity,
+                          "client-id.data": "bench"}
+                yield ("update_drilldowns", view + " sel={} {}".format(selection, granularity), True), \
+                    lambda values=values: run_drilldowns(client, values)
+
+    for name, locations in (("taxi click", [161]), ("taxi lasso", borough)):
+        values = {"taxi-choropleth.selectedData": {"points": [{"location": location}
+                                                              for location in locations]}}
+        yield ("update_selection", name, False), lambda values=values: run_callback(
+            client, "current-selection.data", values, "taxi-choropleth.selectedData")
+
+    # figure building and color binning on their own
+    for isRatio, start, end in ranges[1::2]:
+        tdf = app.get_current_taxidf(data.build, start, end, isRatio)
+        view = "{} {}-{}".format("ratio" if isRatio else "raw", data.months[start], data.months[end])
+        for isBivariate in (False, True):
+            hover_data, coloring = app.get_view_formatting(isRatio, isBivariate)
+            yield ("get_taxifig", view + " biv={}".format(isBivariate), False), \
+                lambda tdf=tdf, hover_data=hover_data, coloring=coloring, isBivariate=isBivariate: \
+                    app.get_taxifig([], tdf, hover_data, coloring, isBivariate,
+                                    app.defaultCenter, app.defaultZoom).to_dict()
+    random = np.random.default_rng(0)
+    for n in (len(data.taxi_attributes), 10**5):
+        x, y = random.random(n), random.random(n)
+        yield ("data2color", "n={}".format(n), False), lambda x=x, y=y: data2color(
+            x, y, 0.33, 0.66, 0.33, 0.66, app.biv_colors).tolist()
+
+def run():
+    results = {}
+    print("{:<26} {:<40} {:>5} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+        "callback", "case", "mode", "p50 ms", "p90 ms", "p99 ms", "bytes", "peak KB"))
+    for (callback, case, cached), call in cases():
+        for cold in (True, False) if cached else (True,):
+            mode = "cold" if cold else "warm"
+            latencies, size, peak = measure(call, cold)
+            stats = dict(zip(["p{}".format(p) for p in percentiles],
+                             np.percentile(latencies, percentiles).tolist()),
+                         bytes=size, peak=peak)
+            results["{} | {} | {}".format(callback, case, mode)] = stats
+            print("{:<26} {:<40} {:>5} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>10.0f}".format(
+                callback, case, mode, *(stats["p{}".format(p)] * 1000 for p in percentiles),
+                size, peak / 1024))
+    return results
+
+def compare(base, new, threshold=threshold):
+    # prints the cases of both runs side by side, returns the cases whose
+    # median latency grew by more than threshold
+    regressions = []
+    print("{:<80} {:>9} {:>9} {:>7} {:>10} {:>10}".format(
+        "case", "base p50", "new p50", "ratio", "base bytes", "new bytes"))
+    for key in base:
+        if key not in new:
+            continue
+        ratio = new[key]["p50"] / base[key]["p50"] if base[key]["p50"] else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            flag = " slower"
+        print("{:<80} {:>9.2f} {:>9.2f} {:>7.2f} {:>10} {:>10}{}".format(
+            key, base[key]["p50"] * 1000, new[key]["p50"] * 1000, ratio,
+            base[key]["bytes"], new[key]["bytes"], flag))
+    return regressions
+
+# main
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["--compare"]:
+        with open(args[1]) as f:
+            base = json.load(f)
+        with open(args[2]) as f:
+            new = json.load(f)
+        regressions = compare(base, new, float(args[3]) if len(args) > 3 else threshold)
+        print("{} of {} cases slower".format(len(regressions), len(set(base) & set(new))))
+        sys.exit(1 if regressions else 0)
+
+    if args[:1] == ["-n"]:
+        repeats, args = int(args[1]), args[2:]
+    results = run()
+    if args[:1] == ["--json"]:
+        with open(args[1], "w") as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,195 @@
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Bounded caches for results computed by the callbacks: LRUCache in process,
+# FileCache in a directory shared by the worker processes, and TieredCache
+# combining the two.
+
+_missing = object()
+
+class LRUCache:
+    # mapping of at most maxsize entries, evicting the least recently used
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {"size": len(self.entries), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses}
+
+class FileCache:
+    # pickled entries in one file each under path, shared by every process
+    # using the same path, of at most maxbytes in total, evicting the least
+    # recently used. Writes are atomic renames, so concurrent readers see
+    # either the old or the new entry
+    def __init__(self, path, maxbytes=256 * 2**20):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + ".pkl")
+
+    def get(self, key, default=None):
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                stored_key, value = pickle.load(f)
+        except FileNotFoundError:
+            stored_key = _missing
+        except (EOFError, pickle.UnpicklingError):
+            stored_key = _missing
+            self.remove(path)
+        if stored_key != key:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # the modification time orders the entries for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def set(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.entry_path(key))
+        self.evict()
+
+    def entries(self):
+        # (mtime, size, path) of the entries
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".pkl"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.maxbytes:
+                break
+            self.remove(path)
+            size -= entry_size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            self.remove(path)
+
+    def __contains__(self, key):
+        return os.path.exists(self.entry_path(key))
+
+    def __len__(self):
+        return len(self.entries())
+
+    def stats(self):
+        entries = self.entries()
+        return {"size": len(entries), "bytes": sum(entry[1] for entry in entries),
+                "maxbytes": self.maxbytes, "hits": self.hits, "misses": self.misses}
+
+class TieredCache:
+    # a process-local cache in front of a shared one, values found in the
+    # shared cache are kept locally so that they are unpickled once per process
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = self.local.get(key, _missing)
+        if value is _missing:
+            value = self.shared.get(key, _missing)
+            if value is _missing:
+                return default
+            self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        self.shared.set(key, value)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def __contains__(self, key):
+        return key in self.local or key in self.shared
+
+    def __len__(self):
+        return len(self.shared)
+
+    def stats(self):
+        return {"local": self.local.stats(), "shared": self.shared.stats()}
+
+def memoize(cache):
+    # caches the results of the decorated function in cache, keyed by its
+    # positional arguments, which must be hashable
+    # the cached results are shared between callers and must not be modified,
+    # and a call that raises caches nothing, so that a function can refuse to
+    # compute a result for its key (see app.build_data)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (func.__name__,) + args
+            value = cache.get(key, _missing)
+            if value is _missing:
+                value = func(*args)
+                cache.set(key, value)
+            return value
+        def cached(*args):
+            # whether the result for args is in the cache
+            return (func.__name__,) + args in cache
+        wrapper.cache = cache
+        wrapper.cached = cached
+        return wrapper
+    return decorator
@@ -0,0 +1,68 @@
+import numpy as np
+
+def prefix_sums(values):
+    # cumulative sum of values along the first axis, with a leading row of zeros
+    values = np.asarray(values, dtype=np.float64)
+    cumsum = np.zeros((values.shape[0] + 1,) + values.shape[1:])
+    np.cumsum(values, axis=0, out=cumsum[1:])
+    return cumsum
+
+class PrefixCube:
+    # values: array of shape (nperiods, ...) e.g. month x {yellow, green} x zone
+    # keeps the cumulative sum along the period axis, with a leading row of
+    # zeros, so that the sum over any inclusive range [start, end] of periods
+    # is a single subtraction of two rows
+    # cumsum: prefix_sums(values) computed beforehand, e.g. memory-mapped from
+    # the data store, which is used as is instead of values
+    def __init__(self, values=None, cumsum=None):
+        self.cumsum = prefix_sums(values) if cumsum is None else cumsum
+        self.nperiods = self.cumsum.shape[0] - 1
+
+    def range_sum(self, start, end):
+        # sum of the periods start..end, both inclusive
+        if not (0 <= start <= end < self.nperiods):
+            raise ValueError(
+                'range [{}, {}] is outside of the {} periods'.format(start, end, self.nperiods))
+        return self.cumsum[end + 1] - self.cumsum[start]
+
+    def range_mean(self, start, end):
+        return self.range_sum(start, end) / (end - start + 1)
+
+def period_starts(dates, freq):
+    # first day of the period of each date, freq "D" (days), "W" (weeks
+    # starting on monday) or "M" (months)
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    if freq == "D":
+        return dates
+    if freq == "W":
+        # 1970-01-01 was a thursday
+        return dates - (dates.astype(np.int64) + 3) % 7
+    if freq == "M":
+        return dates.astype("datetime64[M]").astype("datetime64[D]")
+    raise ValueError("unknown frequency {}".format(freq))
+
+class DateCube(PrefixCube):
+    # PrefixCube over days, dates: sorted datetime64[D] of the periods of
+    # values, days without data may be missing. Ranges are given as dates,
+    # both inclusive, and only cover the days present
+    def __init__(self, dates, values=None, cumsum=None):
+        super().__init__(values, cumsum)
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+
+    def rows(self, start, end):
+        # row range [first, last) of the days start..end
+        return (np.searchsorted(self.dates, np.datetime64(start, "D"), side="left"),
+                np.searchsorted(self.dates, np.datetime64(end, "D"), side="right"))
+
+    def rollup(self, start, end, freq):
+        # first days of the periods (freq as in period_starts) of the days
+        # start..end that have data, and the sums over each of them. A period
+        # that begins before start, e.g. the week of the first day, only sums
+        # its days from start on and is labelled with start
+        first, last = self.rows(start, end)
+        periods = period_starts(self.dates[first:last], freq)
+        starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]]) if len(periods) else \
+                    np.zeros(0, dtype=np.int64)
+        bounds = np.append(starts, len(periods)) + first
+        return np.maximum(periods[starts], np.datetime64(start, "D")), \
+            self.cumsum[bounds[1:]] - self.cumsum[bounds[:-1]]
@@ -0,0 +1,379 @@
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import geometry
+import tiles
+from cube import prefix_sums
+
+# Binary columnar store of the dashboard data. The build step converts the
+# files of taxi_data/, taxi_data/by_date/, taxi_data/by_day/ and covid_data/
+# into one .npy
+# file per column, the loader memory-maps them read-only so that every worker
+# shares the same pages instead of parsing and holding private copies. The
+# prefix sums the app queries and the map geometry the browser draws are
+# written to the store too, so that workers do not each derive their own.
+#
+#   python datastore.py [store_path]                      (re)builds the store
+#   python datastore.py --update YYYY-MM [YYYY-MM ...]    updates or appends months
+
+store_path = "store/"
+covid_data_path = "covid_data/"
+taxi_data_path = "taxi_data/"
+taxi_zone_path = "taxi_data/by_zone/"
+taxi_date_path = "taxi_data/by_date/"
+taxi_day_path = "taxi_data/by_day/"
+
+store_version = 6
+taxi_types = ["yellow", "green"]
+
+# column name -> file, the manifest records the dtype and shape of each
+store_columns = [
+    # timeline of the month arrays, "YYYY-MM"
+    "months",
+    # taxi zones, in the order of the zone axis, "" for missing names
+    "zone_ids", "zone_borough", "zone_name", "zone_service",
+    # month x {yellow, green} x zone revenue
+    "taxi_revenue",
+    # zip codes, in the order of the zip axis
+    "zip_codes",
+    # month x zip hospitalization rate, 0 for months without covid data
+    "covid_rate",
+    # per zone time series of the drilldown, one row per zone, type and date
+    "series_zone", "series_type", "series_date", "series_trips", "series_cost",
+    # day x {yellow, green} x zone trips and revenue, for the days of the months
+    # ingested from raw trip files, the only ones known per day
+    "day_dates", "day_trips", "day_revenue",
+    # prefix sums over the first axis of the columns of derived_columns
+    "taxi_revenue_cumsum", "covid_rate_cumsum", "day_trips_cumsum", "day_revenue_cumsum",
+]
+
+# column -> column it is the prefix sums of, computed when the store is written
+derived_columns = {
+    "taxi_revenue_cumsum": "taxi_revenue",
+    "covid_rate_cumsum": "covid_rate",
+    "day_trips_cumsum": "day_trips",
+    "day_revenue_cumsum": "day_revenue",
+}
+
+
+def _month_files(pattern, regex):
+    # {"YYYY-MM": path} of the files matching pattern
+    files = {}
+    for path in glob.glob(pattern):
+        match = re.search(regex, os.path.basename(path))
+        if match:
+            files["{}-{:02}".format(match.group(1), int(match.group(2)))] = path
+    return files
+
+def _source_files():
+    # {"YYYY-MM": path} of the taxi month, covid month, by_date and by_day files
+    return (_month_files(taxi_data_path + "taxi_data_*.csv",
+                         r"^taxi_data_(\d{4})-(\d{1,2})\.csv$"),
+            _month_files(covid_data_path + "covid_data-*.csv",
+                         r"^covid_data-(\d{4})-(\d{1,2})\.csv$"),
+            _month_files(taxi_date_path + "taxi_data_*.csv",
+                         r"^taxi_data_(\d{4})-(\d{1,2})\.csv$"),
+            _month_files(taxi_day_path + "taxi_data_*.npz",
+                         r"^taxi_data_(\d{4})-(\d{1,2})\.npz$"))
+
+def _read_taxi_month(path, zone_ids):
+    # {yellow, green} x zone revenue of a month file
+    dfmonth = pd.read_csv(path).set_index("PULocationID").reindex(zone_ids)
+    return np.array([dfmonth[taxi_type + "_total_amount"].fillna(0) for taxi_type in taxi_types])
+
+def _read_covid_month(path, zip_codes):
+    dfmonth = pd.read_csv(path).set_index("zip_code").reindex(zip_codes)
+    return dfmonth["hospitalization_rate"].fillna(0).to_numpy()
+
+def _read_series(date_files):
+    # series columns of the drilldown from the by_date files, sorted by zone,
+    # date and type
+    series = [pd.DataFrame(columns=["location_id", "taxi_type", "num_trips", "total_cost", "date"])]
+    for month, path in date_files.items():
+        dfmonth = pd.read_csv(path, usecols=["location_id", "taxi_type", "num_trips",
+                                              "total_cost"])
+        dfmonth["date"] = month + "-01"
+        series.append(dfmonth)
+    series = pd.concat(series).sort_values(["location_id", "date", "taxi_type"])
+    return {
+        "series_zone": series["location_id"].to_numpy(dtype=np.int16),
+        "series_type": series["taxi_type"].map(taxi_types.index).to_numpy(dtype=np.int8),
+        "series_date": series["date"].to_numpy(dtype="datetime64[D]"),
+        "series_trips": series["num_trips"].to_numpy(dtype=np.int32),
+        "series_cost": series["total_cost"].to_numpy(dtype=np.float64),
+    }
+
+def _read_days(day_files, zone_ids):
+    # day columns from the by_day files, in date order
+    shape = (len(taxi_types), len(zone_ids))
+    dates = [np.zeros(0, dtype="datetime64[D]")]
+    trips = [np.zeros((0,) + shape, dtype=np.int32)]
+    revenue = [np.zeros((0,) + shape)]
+    for month in sorted(day_files):
+        with np.load(day_files[month]) as days:
+            # reindexed to the zone axis of the store
+            columns = pd.Index(days["location_ids"]).get_indexer(zone_ids)
+            found = columns >= 0
+            dates.append(days["dates"].astype("datetime64[D]"))
+            trips.append(np.zeros((len(days["dates"]),) + shape, dtype=np.int32))
+            trips[-1][:, :, found] = days["trips"][:, :, columns[found]]
+            revenue.append(np.zeros((len(days["dates"]),) + shape))
+            revenue[-1][:, :, found] = days["revenue"][:, :, columns[found]]
+    return {"day_dates": np.concatenate(dates),
+            "day_trips": np.concatenate(trips),
+            "day_revenue": np.concatenate(revenue)}
+
+def read_sources():
+    # reads the CSV files into the arrays of store_columns
+    taxi_files, covid_files, date_files, day_files = _source_files()
+    months = sorted(taxi_files)
+    if not months:
+        raise FileNotFoundError("no taxi data found in " + taxi_data_path)
+
+    zones = pd.read_csv(taxi_files[months[0]]).set_index("PULocationID")
+    zone_ids = zones.index.to_numpy()
+    taxi_revenue = np.array([_read_taxi_month(taxi_files[month], zone_ids) for month in months])
+
+    covid_months = [month for month in months if month in covid_files]
+    zip_codes = pd.read_csv(covid_files[covid_months[0]])["zip_code"].to_numpy() \
+                    if covid_months else np.zeros(0)
+    covid_rate = np.zeros((len(months), len(zip_codes)))
+    for month in covid_months:
+        covid_rate[months.index(month)] = _read_covid_month(covid_files[month], zip_codes)
+
+    columns = _read_series({month : date_files[month] for month in months if month in date_files})
+    columns.update(_read_days({month : day_files[month] for month in months if month in day_files},
+                              zone_ids))
+    columns.update({
+        "months": np.array(months),
+        "zone_ids": zone_ids.astype(np.int16),
+        "zone_borough": zones["Borough"].fillna("").to_numpy(dtype=str),
+        "zone_name": zones["Zone"].fillna("").to_numpy(dtype=str),
+        "zone_service": zones["service_zone"].fillna("").to_numpy(dtype=str),
+        "taxi_revenue": taxi_revenue,
+        "zip_codes": zip_codes.astype(np.int32),
+        "covid_rate": covid_rate,
+    })
+    return columns
+
+def geometry_digest():
+    # digest of what the geometry and tiles of the store are built from: the
+    # boundary files, their levels and tiles and whether shapely builds them
+    try:
+        import shapely
+        shapely_version = shapely.__version__
+    except ImportError:
+        shapely_version = None
+    digest = hashlib.sha1(repr((store_version, shapely_version, geometry.level_zooms,
+                                tiles.tile_maxzoom, tiles.extent, tiles.buffer)).encode())
+    for source_path, id_property, key_property, simpler_path in geometry.geometry_sources.values():
+        for path in (source_path, simpler_path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def _copy_geometry(path, tmp_path):
+    # geometry and tiles of the store at path, copied to tmp_path
+    shutil.copyfile(os.path.join(path, geometry.geometry_script),
+                    os.path.join(tmp_path, geometry.geometry_script))
+    for name in (geometry.geometry_path, tiles.tile_path):
+        if os.path.exists(os.path.join(path, name)):
+            shutil.copytree(os.path.join(path, name), os.path.join(tmp_path, name))
+
+@contextlib.contextmanager
+def store_lock(path=store_path):
+    # exclusive lock of the store at path between processes, held while it is
+    # built or updated, so that the workers starting together on a missing
+    # store build it once and the others wait for it. There is no lock
+    # without fcntl (Windows), where the app runs in a single process
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(os.path.normpath(path) + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def write_store(columns, path=store_path):
+    # writes the columns to a temporary directory that then replaces path,
+    # so that readers never see a half-written store, store_lock is held by
+    # the caller
+    path = os.path.normpath(path)
+    tmp_path = path + ".tmp-" + str(os.getpid())
+    os.makedirs(tmp_path)
+    # build identifies this write of the store, readers compare it to notice
+    # that the store changed
+    manifest = {"version": store_version, "build": str(time.time_ns()), "columns": {}}
+    columns = dict(columns)
+    for name, source in derived_columns.items():
+        columns[name] = prefix_sums(columns[source])
+    for name in store_columns:
+        values = np.ascontiguousarray(columns[name])
+        np.save(os.path.join(tmp_path, name + ".npy"), values, allow_pickle=False)
+        manifest["columns"][name] = {"dtype": values.dtype.str, "shape": values.shape}
+    # the geometry and tiles only depend on the boundaries, they are copied
+    # from the store being replaced if it has them from the same ones
+    manifest["geometry"] = geometry_digest()
+    if (_manifest_at(path) or {}).get("geometry") == manifest["geometry"]:
+        _copy_geometry(path, tmp_path)
+    else:
+        geometry.write_geometry(tmp_path)
+        tiles.write_tiles(tmp_path)
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    old_path = None
+    if os.path.exists(path):
+        old_path = path + ".old-" + str(os.getpid())
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if old_path:
+        shutil.rmtree(old_path)
+
+def build(path=store_path):
+    with store_lock(path):
+        write_store(read_sources(), path)
+
+def next_month(month):
+    return str(np.datetime64(month, "M") + 1)
+
+def updated_months(months, stored):
+    # months of the store after an update of the given months, the stored
+    # ones followed by the new ones, ValueError if a new month does not
+    # follow the last one
+    stored = list(stored)
+    for month in sorted(set(months)):
+        if month not in stored:
+            if month != next_month(stored[-1]):
+                raise ValueError("{} neither is in the store nor follows its last month {}"
+                                 .format(month, stored[-1]))
+            stored.append(month)
+    return stored
+
+def update_months(months, path=store_path):
+    # rewrites the store at path with the given months read again from their
+    # CSV files, months following the last one of the store are appended.
+    # Only the files of those months are read, the rest of the store is copied
+    # from its current arrays
+    with store_lock(path):
+        _update_months(months, path)
+
+def _update_months(months, path):
+    store = DataStore(path)
+    taxi_files, covid_files, date_files, day_files = _source_files()
+    columns = {name : np.array(getattr(store, name)) for name in store_columns}
+    stored = updated_months(months, columns["months"].tolist())
+    months = sorted(set(months))
+    for month in months:
+        if month not in taxi_files:
+            raise FileNotFoundError("no taxi data for {} in {}".format(month, taxi_data_path))
+
+    nappended = len(stored) - len(columns["months"])
+    columns["months"] = np.array(stored)
+    columns["taxi_revenue"] = np.concatenate(
+        [columns["taxi_revenue"], np.zeros((nappended,) + columns["taxi_revenue"].shape[1:])])
+    columns["covid_rate"] = np.concatenate(
+        [columns["covid_rate"], np.zeros((nappended,) + columns["covid_rate"].shape[1:])])
+    for month in months:
+        m = stored.index(month)
+        columns["taxi_revenue"][m] = _read_taxi_month(taxi_files[month], columns["zone_ids"])
+        if month in covid_files:
+            columns["covid_rate"][m] = _read_covid_month(covid_files[month], columns["zip_codes"])
+
+    # series rows of the updated months are replaced by those of their files
+    dates = np.array([month + "-01" for month in months], dtype="datetime64[D]")
+    keep = ~np.isin(columns["series_date"], dates)
+    new_columns = _read_series({month : date_files[month] for month in months
+                                if month in date_files})
+    for name, values in new_columns.items():
+        columns[name] = np.concatenate([columns[name][keep], values])
+    # same order as read_sources, which sorts the types by name
+    order = np.lexsort((np.array(taxi_types)[columns["series_type"]],
+                        columns["series_date"], columns["series_zone"]))
+    for name in new_columns:
+        columns[name] = columns[name][order]
+
+    # days of the updated months are replaced by those of their by_day files
+    keep = ~np.isin(columns["day_dates"].astype("datetime64[M]"), dates.astype("datetime64[M]"))
+    new_columns = _read_days({month : day_files[month] for month in months if month in day_files},
+                             columns["zone_ids"])
+    for name, values in new_columns.items():
+        columns[name] = np.concatenate([columns[name][keep], values])
+    order = np.argsort(columns["day_dates"], kind="stable")
+    for name in new_columns:
+        columns[name] = columns[name][order]
+
+    del store
+    write_store(columns, path)
+
+class DataStore:
+    # read-only memory-mapped view of a built store, one attribute per column
+    def __init__(self, path=store_path):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest["version"] != store_version:
+            raise ValueError("store at {} has version {}, expected {}".format(
+                path, self.manifest["version"], store_version))
+        self.path = path
+        self.build = self.manifest.get("build", "")
+        for name in store_columns:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"),
+                                        mmap_mode="r", allow_pickle=False))
+
+    def zone_attributes(self):
+        # taxi zone lookup columns of the choropleth frames
+        def names(values):
+            return np.where(values == "", None, values.astype(object))
+        return pd.DataFrame({"PULocationID": self.zone_ids.astype(np.int64),
+                             "Borough": names(self.zone_borough),
+                             "Zone": names(self.zone_name),
+                             "service_zone": names(self.zone_service)})
+
+def _manifest_at(path):
+    # manifest of the store at path, None if there is none
+    try:
+        with open(os.path.join(path, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def store_build_at(path):
+    # build of the store at path, None if there is none
+    manifest = _manifest_at(path)
+    return None if manifest is None else manifest.get("build", "")
+
+def store_version_at(path):
+    # version of the store at path, None if there is none
+    manifest = _manifest_at(path)
+    return None if manifest is None else manifest["version"]
+
+def load(path=store_path):
+    # memory-maps the store at path, (re)building it first if there is none
+    # or it was built by another version of this module, or waiting for the
+    # process building it
+    if store_version_at(path) != store_version:
+        with store_lock(path):
+            if store_version_at(path) != store_version:
+                write_store(read_sources(), path)
+    return DataStore(path)
+
+# main
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--update"]:
+        update_months(sys.argv[2:])
+    else:
+        build(sys.argv[1] if len(sys.argv) > 1 else store_path)
@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+from cube import DateCube
+from datastore import taxi_types
+
+# In-memory time series indexes of the drilldowns, built once at startup from
+# the data store so that a click slices arrays instead of parsing CSV files.
+
+class TaxiSeriesIndex:
+    # per zone revenue series, keyed by location_id
+    def __init__(self, store):
+        self.zone = store.series_zone
+        self.taxi_type = np.array(taxi_types)[store.series_type]
+        self.date = store.series_date
+        self.num_trips = store.series_trips
+        self.total_cost = store.series_cost
+        self.zone_names = dict(zip(store.zone_ids.tolist(), store.zone_name.tolist()))
+        # the store keeps the rows sorted by zone, so each zone is one slice
+        ids, starts, counts = np.unique(self.zone, return_index=True, return_counts=True)
+        self.slices = {location_id : (start, start + count)
+                        for location_id, start, count in zip(ids.tolist(), starts, counts)}
+
+    def rows(self, location_ids):
+        # row numbers of the series of the given zones
+        slices = [self.slices[location_id] for location_id in location_ids
+                    if location_id in self.slices]
+        if not slices:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, end) for start, end in slices])
+
+    def frame(self, location_ids, dates):
+        # series of the given zones restricted to dates, one row per zone,
+        # taxi type and month
+        rows = self.rows(location_ids)
+        rows = rows[np.isin(self.date[rows], np.array(dates, dtype="datetime64[D]"))]
+        zone = self.zone[rows].astype(np.int64)
+        return pd.DataFrame({"location_id": zone,
+                             "taxi_type": self.taxi_type[rows],
+                             "num_trips": self.num_trips[rows],
+                             "total_cost": self.total_cost[rows],
+                             "date": pd.to_datetime(self.date[rows]),
+                             "zone_name": [self.zone_names[location_id] for location_id in zone]})
+
+    def total(self, location_ids, dates):
+        # series of the sum of the given zones restricted to dates, one row
+        # per taxi type and month
+        rows = self.rows(location_ids)
+        rows = rows[np.isin(self.date[rows], np.array(dates, dtype="datetime64[D]"))]
+        total = pd.DataFrame({"date": self.date[rows],
+                              "taxi_type": self.taxi_type[rows],
+                              "num_trips": self.num_trips[rows].astype(np.int64),
+                              "total_cost": self.total_cost[rows]}) \
+            .groupby(["date", "taxi_type"], as_index=False).sum()
+        total["date"] = pd.to_datetime(total["date"])
+        return total
+
+class TaxiDailyIndex:
+    # per zone daily trips and revenue, rolled up to days, weeks or months on
+    # demand through prefix sums over the days
+    def __init__(self, store):
+        self.trips = DateCube(store.day_dates, cumsum=store.day_trips_cumsum)
+        self.revenue = DateCube(store.day_dates, cumsum=store.day_revenue_cumsum)
+        self.zone_columns = {location_id : column
+                                for column, location_id in enumerate(store.zone_ids.tolist())}
+        self.zone_names = dict(zip(store.zone_ids.tolist(), store.zone_name.tolist()))
+        # months with daily data
+        self.months = set(np.unique(self.trips.dates.astype("datetime64[M]")).tolist())
+
+    def __len__(self):
+        return len(self.trips.dates)
+
+    def covers(self, start, end):
+        # whether every month of the days start..end has daily data
+        months = np.arange(np.datetime64(start, "M"), np.datetime64(end, "M") + 1)
+        return all(month in self.months for month in months.tolist())
+
+    def _rollups(self, location_ids, ranges, freq):
+        # periods, trips and revenue (period x type x zone) of the given
+        # zones over each range, the types in name order like the rows of the
+        # store's series
+        columns = [self.zone_columns[location_id] for location_id in location_ids]
+        types = np.argsort(taxi_types)
+        for start, end in ranges:
+            periods, trips = self.trips.rollup(start, end, freq)
+            revenue = self.revenue.rollup(start, end, freq)[1]
+            yield periods, trips[:, types][:, :, columns], revenue[:, types][:, :, columns]
+
+    def frame(self, location_ids, ranges, freq):
+        # series of the given zones over the days of the (start, end) date
+        # ranges, one row per zone, taxi type and period of freq ("D", "W" or
+        # "M"), with the same columns as TaxiSeriesIndex.frame
+        location_ids = [location_id for location_id in location_ids
+                        if location_id in self.zone_columns]
+        types = np.argsort(taxi_types)
+        frames = []
+        for periods, trips, revenue in self._rollups(location_ids, ranges, freq):
+            # period x type x zone, flattened in zone, period, type order
+            shape = (len(location_ids), len(periods), len(types))
+            frames.append(pd.DataFrame({
+                "location_id": np.broadcast_to(np.array(location_ids, dtype=np.int64)[:, None, None], shape).ravel(),
+                "taxi_type": np.broadcast_to(np.array(taxi_types)[types][None, None, :], shape).ravel(),
+                "num_trips": trips.transpose(2, 0, 1).ravel().astype(np.int64),
+                "total_cost": revenue.transpose(2, 0, 1).ravel(),
+                "date": pd.to_datetime(np.broadcast_to(periods[None, :, None], shape).ravel())}))
+        all_data = pd.concat(frames, ignore_index=True)
+        all_data["zone_name"] = [self.zone_names[location_id] for location_id in all_data["location_id"]]
+        return all_data
+
+    def total(self, location_ids, ranges, freq):
+        # series of the sum of the given zones over the ranges, one row per
+        # taxi type and period of freq, with the columns of
+        # TaxiSeriesIndex.total
+        location_ids = [location_id for location_id in location_ids
+                        if location_id in self.zone_columns]
+        types = np.argsort(taxi_types)
+        frames = []
+        for periods, trips, revenue in self._rollups(location_ids, ranges, freq):
+            # summed over the zones, flattened in period, type order
+            shape = (len(periods), len(types))
+            frames.append(pd.DataFrame({
+                "date": pd.to_datetime(np.broadcast_to(periods[:, None], shape).ravel()),
+                "taxi_type": np.broadcast_to(np.array(taxi_types)[types][None, :], shape).ravel(),
+                "num_trips": trips.sum(axis=2).ravel().astype(np.int64),
+                "total_cost": revenue.sum(axis=2).ravel()}))
+        return pd.concat(frames, ignore_index=True)
+
+class CovidSeriesIndex:
+    # per zip hospitalization rate series, keyed by zip_code
+    def __init__(self, store):
+        self.rate = store.covid_rate
+        self.zip_codes = store.zip_codes.astype(np.int64)
+        self.month_rows = {month : row for row, month in enumerate(store.months.tolist())}
+
+    def frame(self, zip_codes, dates):
+        # series of the given zips at the given month dates, one row per month
+        # and zip, dates without covid data are left out
+        columns = np.flatnonzero(np.isin(self.zip_codes, zip_codes))
+        present = [date for date in dates if date.strftime("%Y-%m") in self.month_rows]
+        rows = [self.month_rows[date.strftime("%Y-%m")] for date in present]
+        return pd.DataFrame({"date": np.repeat(present, len(columns)),
+                             "zip_code": np.tile(self.zip_codes[columns], len(rows)),
+                             "hospitalization_rate": self.rate[rows][:, columns].ravel()})
+
+    def mean(self, zip_codes, dates):
+        # mean hospitalization rate of the given zips at the given month
+        # dates, one row per month
+        columns = np.flatnonzero(np.isin(self.zip_codes, zip_codes))
+        present = [date for date in dates if date.strftime("%Y-%m") in self.month_rows]
+        rows = [self.month_rows[date.strftime("%Y-%m")] for date in present]
+        return pd.DataFrame({"date": present,
+                             "hospitalization_rate": self.rate[rows][:, columns].mean(axis=1)})
+
+def load_events(path):
+    # nyc events shown on the covid drilldown, only lockdowns and openings
+    events = pd.read_csv(path, parse_dates=['date'])
+    return events[events["type"].isin(["lockdown", "opening"])].reset_index(drop=True)
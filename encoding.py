@@ -0,0 +1,96 @@
+import base64
+import json
+
+import numpy as np
+
+# Compact encoding of the data arrays of the figures sent to the browser,
+# decoded by assets/arrays.js. A numeric array is sent as a base64 typed
+# array, {"dtype", "bdata"} like the typed arrays of newer plotly.js
+# versions: integers as int16 or int32, the arrays that only color or place
+# the zones (float32_keys) as float32, the other floats, which the hover
+# shows with their decimals, as float64. An array of strings is sent as its
+# distinct strings and the typed array of their indexes, and a 2D array
+# (customdata) column by column. Each array is only encoded if that makes it
+# shorter, short arrays and arrays of other values are left as they are.
+
+# data arrays of a trace, and of its marker
+array_keys = ["locations", "z", "customdata", "hovertext", "text", "x", "y", "lat", "lon",
+              "selectedpoints"]
+marker_array_keys = ["color"]
+float32_keys = {"z", "lat", "lon", "color"}
+min_length = 8
+
+def typed_array(values, float32=False):
+    # {"dtype", "bdata"} of a numeric numpy array, or None if it is not
+    # numeric or its integers do not fit in int32
+    if values.dtype.kind in "iu":
+        if len(values) and (values.min() < -2**31 or values.max() >= 2**31):
+            return None
+        small = not len(values) or (values.min() >= -2**15 and values.max() < 2**15)
+        dtype, code = (np.dtype("<i2"), "i2") if small else (np.dtype("<i4"), "i4")
+    elif values.dtype.kind == "f":
+        dtype, code = (np.dtype("<f4"), "f4") if float32 else (np.dtype("<f8"), "f8")
+    else:
+        return None
+    return {"dtype": code, "bdata": base64.b64encode(values.astype(dtype).tobytes()).decode()}
+
+def string_table(values):
+    # {"dtype": "str", "strings", "index"} of a list of strings, missing
+    # values (None or NaN) included as null, or None for other values
+    values = [None if isinstance(value, float) and value != value else value for value in values]
+    if not all(value is None or isinstance(value, str) for value in values):
+        return None
+    strings = list(dict.fromkeys(values))
+    positions = {string : i for i, string in enumerate(strings)}
+    return {"dtype": "str", "strings": strings,
+            "index": typed_array(np.array([positions[value] for value in values]))}
+
+def _size(value):
+    return len(json.dumps(value, default=str))
+
+def encode_array(values, float32=False):
+    # encoded form of a 1D or 2D array of a trace, or values as they are if
+    # it cannot be encoded or that is not shorter
+    if isinstance(values, dict) or len(values) < min_length:
+        return values
+    if isinstance(values[0], (list, tuple, np.ndarray)):
+        if len({len(row) for row in values}) != 1:
+            return values
+        encoded = {"dtype": "columns",
+                   "columns": [encode_array([row[j] for row in values], float32)
+                               for j in range(len(values[0]))]}
+        plain = [list(row) for row in values]
+    else:
+        array = np.asarray(values)
+        if array.ndim != 1:
+            return values
+        if array.dtype.kind in "fiu":
+            encoded = typed_array(array, float32)
+        elif array.dtype.kind in "USO":
+            # the values themselves, numpy makes strings of the numbers of
+            # an array of numbers and strings
+            encoded = string_table(list(values))
+        else:
+            encoded = None
+        plain = array.tolist()
+    if encoded is None or _size(encoded) >= _size(plain):
+        return values
+    return encoded
+
+def encode_figure(figure):
+    # figure dict with the data arrays of its traces encoded, the traces are
+    # copied, the arrays left unchanged
+    data = []
+    for trace in figure["data"]:
+        trace = dict(trace)
+        for key in array_keys:
+            if trace.get(key) is not None:
+                trace[key] = encode_array(trace[key], key in float32_keys)
+        marker = trace.get("marker")
+        if marker is not None:
+            trace["marker"] = marker = dict(marker)
+            for key in marker_array_keys:
+                if isinstance(marker.get(key), (list, tuple, np.ndarray)):
+                    marker[key] = encode_array(marker[key], key in float32_keys)
+        data.append(trace)
+    return dict(figure, data=data)
@@ -0,0 +1,96 @@
+import json
+import logging
+import math
+import os
+import shutil
+
+import numpy as np
+
+# Multi-resolution map geometry. The full resolution zone and zip boundaries
+# are simplified once per level of detail, with their coordinates rounded to
+# a grid finer than a screen pixel at the zooms the level is drawn at, and the
+# browser draws the level matching the zoom of the map (see
+# assets/choropleth.js), fetching each level the first time it is needed.
+# The levels are written to the store by datastore.py. Simplifying needs
+# shapely, without it the pre-simplified files are used at every zoom.
+#
+#   python geometry.py        prints the size of each level
+
+# map id -> full resolution geojson, its id property, the id property of the
+# figures (featureidkey) and the pre-simplified geojson
+geometry_sources = {
+    "taxi-choropleth": ("map_data/taxi_zones.geojson", "LocationID", "location_id",
+                        "map_data/taxi_zones_2_simpler.json"),
+    "covid-choropleth": ("map_data/zip_codes.geojson", "postalCode", "postalCode",
+                         "map_data/zip_codes_simpler.json"),
+}
+
+# each level is drawn below its zoom and at or above the zoom of the level
+# before it, the last one at every higher zoom too
+level_zooms = [10, 12, 14, 16]
+
+# files of the store: the script listing the levels of each map, loaded with
+# the page, and geometry_path/<map id>-<level>.json, one per level
+geometry_script = "geometry.js"
+geometry_path = "geometry"
+
+log = logging.getLogger(__name__)
+
+def pixel_degrees(zoom):
+    # longitude span of a screen pixel of the web mercator tiles at zoom
+    return 360 / (256 * 2**zoom)
+
+def simplified_levels(path, id_property, key_property):
+    # the features of a geojson file as one FeatureCollection per zoom of
+    # level_zooms, with the zoom as "maxzoom" member, simplified to a pixel
+    # and rounded to a quarter pixel at that zoom. The features only keep
+    # their id, as key_property
+    import shapely
+    from shapely.geometry import mapping, shape
+
+    with open(path) as f:
+        features = json.load(f)["features"]
+    ids = [str(feature["properties"][id_property]) for feature in features]
+    geometries = np.array([shape(feature["geometry"]) for feature in features])
+    levels = []
+    for zoom in level_zooms:
+        tolerance = pixel_degrees(zoom)
+        decimals = math.ceil(math.log10(4 / tolerance))
+        simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+        simplified = shapely.transform(simplified, lambda coords: np.round(coords, decimals))
+        levels.append({"type": "FeatureCollection", "maxzoom": zoom, "features": [
+            {"type": "Feature", "properties": {key_property: feature_id},
+             "geometry": mapping(geometry)}
+            for feature_id, geometry in zip(ids, simplified)]})
+    return levels
+
+def write_geometry(path):
+    # writes the levels of every map to the store directory path, and the
+    # script setting window.choroplethGeometryLevels, map id -> zoom below
+    # which each level is drawn (null for a single level)
+    try:
+        import shapely
+    except ImportError:
+        shapely = None
+        log.warning("shapely is not installed, the maps are drawn from the pre-simplified geometry")
+    os.makedirs(os.path.join(path, geometry_path), exist_ok=True)
+    maxzooms = {}
+    for map_id, (source_path, id_property, key_property, simpler_path) in geometry_sources.items():
+        if shapely is None:
+            shutil.copyfile(simpler_path, os.path.join(path, geometry_path, map_id + "-0.json"))
+            maxzooms[map_id] = [None]
+            continue
+        levels = simplified_levels(source_path, id_property, key_property)
+        for i, level in enumerate(levels):
+            with open(os.path.join(path, geometry_path, "{}-{}.json".format(map_id, i)), "w") as f:
+                json.dump(level, f, separators=(",", ":"))
+        maxzooms[map_id] = [level["maxzoom"] for level in levels]
+    with open(os.path.join(path, geometry_script), "w") as f:
+        f.write("window.choroplethGeometryLevels = " + json.dumps(maxzooms) + ";\n")
+
+# main
+if __name__ == "__main__":
+    for map_id, (path, id_property, key_property, simpler_path) in geometry_sources.items():
+        for level in simplified_levels(path, id_property, key_property):
+            print("{} below zoom {}: {} bytes".format(
+                map_id, level["maxzoom"], len(json.dumps(level, separators=(",", ":")))))
@@ -0,0 +1,226 @@
+import glob
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import datastore
+from datastore import taxi_data_path, taxi_date_path, taxi_day_path, taxi_zone_path, taxi_types
+
+# Ingestion of the raw TLC trip files (rawdata/{yellow,green}_tripdata_YYYY-MM
+# .csv or .parquet) into the CSV files of taxi_data/. Each file is streamed in
+# chunks that are folded into per taxi type, day and zone totals, so that a
+# multi-GB month never has to fit in memory. The files are aggregated in
+# parallel, one (month, taxi type) per worker process, and the partial totals
+# merged per month. The month, by_date and by_zone files, the daily totals of
+# by_day and the data store are then written from those totals. With --update only the given months are
+# added to the by_zone files and the store, instead of rebuilding both.
+#
+#   python ingest.py [-j workers] [--update] YYYY-MM [YYYY-MM ...]
+
+raw_data_path = "rawdata/"
+zone_lookup_path = taxi_data_path + "taxi_zone_lookup.csv"
+
+chunksize = 1000000
+pickup_columns = {"yellow": "tpep_pickup_datetime", "green": "lpep_pickup_datetime"}
+
+class DailyAggregate:
+    # number of trips and revenue of one month, per taxi type, day and zone,
+    # zone ids run from 1 to nzones, column 0 is left unused
+    def __init__(self, month, nzones):
+        self.month = month
+        self.nzones = nzones
+        self.start = np.datetime64(month, "D")
+        self.ndays = int(((np.datetime64(month, "M") + 1) - self.start).astype(np.int64))
+        shape = (len(taxi_types), self.ndays, nzones + 1)
+        self.trips = np.zeros(shape, dtype=np.int64)
+        self.revenue = np.zeros(shape)
+        self.skipped = 0
+
+    def add(self, taxi_type, pickups, location_ids, amounts):
+        # adds a chunk of trips, pickups as datetime64[D], trips picked up
+        # outside of the month or in an unknown zone are only counted as skipped
+        days = (pickups - self.start).astype(np.int64)
+        valid = (days >= 0) & (days < self.ndays) & (location_ids >= 1) & (location_ids <= self.nzones)
+        self.skipped += len(days) - int(valid.sum())
+        cells = days[valid] * (self.nzones + 1) + location_ids[valid]
+        size = self.ndays * (self.nzones + 1)
+        t = taxi_types.index(taxi_type)
+        self.trips[t] += np.bincount(cells, minlength=size).reshape(self.ndays, -1)
+        self.revenue[t] += np.bincount(cells, weights=amounts[valid],
+                                       minlength=size).reshape(self.ndays, -1)
+
+    def __iadd__(self, other):
+        self.trips += other.trips
+        self.revenue += other.revenue
+        self.skipped += other.skipped
+        return self
+
+    def monthly(self):
+        # taxi type x zone totals of the month, zone k - 1 in column k
+        return self.trips.sum(axis=1)[:, 1:], self.revenue.sum(axis=1)[:, 1:]
+
+def raw_file(taxi_type, month):
+    # path of the raw trip file of a month, None if there is none
+    for extension in [".parquet", ".csv"]:
+        path = raw_data_path + "{}_tripdata_{}{}".format(taxi_type, month, extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+def read_chunks(path, columns):
+    # the columns of a raw trip file, chunksize rows at a time
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, dtype={columns[0]: str},
+                               chunksize=chunksize)
+
+def aggregate_file(path, taxi_type, month, nzones):
+    aggregate = DailyAggregate(month, nzones)
+    pickup = pickup_columns[taxi_type]
+    for chunk in read_chunks(path, [pickup, "PULocationID", "total_amount"]):
+        pickups = pd.to_datetime(chunk[pickup].astype(str).str.slice(0, 10),
+                                 format="%Y-%m-%d", errors="coerce")
+        aggregate.add(taxi_type,
+                      pickups.to_numpy(dtype="datetime64[D]"),
+                      chunk["PULocationID"].fillna(0).to_numpy(dtype=np.int64),
+                      chunk["total_amount"].fillna(0).to_numpy(dtype=np.float64))
+    return aggregate
+
+def aggregate_months(months, nzones, executor):
+    # {month: DailyAggregate} of the months with raw data, the raw files of
+    # every month and taxi type are aggregated concurrently and merged
+    aggregates = {}
+    futures = []
+    for month in months:
+        for taxi_type in taxi_types:
+            path = raw_file(taxi_type, month)
+            if path is None:
+                print("no raw {} data for {}".format(taxi_type, month))
+                continue
+            futures.append((month, executor.submit(aggregate_file, path, taxi_type, month, nzones)))
+    for month, future in futures:
+        if month not in aggregates:
+            aggregates[month] = DailyAggregate(month, nzones)
+        aggregates[month] += future.result()
+    return aggregates
+
+def write_month(aggregate, zones):
+    # taxi_data/taxi_data_YYYY-MM.csv and taxi_data/by_date/taxi_data_YYYY-MM.csv
+    trips, revenue = aggregate.monthly()
+    location_ids = np.arange(1, aggregate.nzones + 1)
+    monthdf = pd.DataFrame({"PULocationID": location_ids})
+    for t, taxi_type in enumerate(taxi_types):
+        monthdf[taxi_type + "_total_amount"] = revenue[t]
+    monthdf["Borough"] = zones["Borough"].to_numpy()
+    monthdf["Zone"] = zones["Zone"].to_numpy()
+    monthdf["service_zone"] = zones["service_zone"].to_numpy()
+    monthdf.to_csv(taxi_data_path + "taxi_data_" + aggregate.month + ".csv",
+                   encoding="utf-8", index=False)
+
+    datedf = pd.concat([pd.DataFrame({"location_id": location_ids,
+                                      "taxi_type": taxi_type,
+                                      "num_trips": trips[taxi_types.index(taxi_type)],
+                                      "total_cost": revenue[taxi_types.index(taxi_type)]})
+                        for taxi_type in sorted(taxi_types)],
+                       ignore_index=True)
+    os.makedirs(taxi_date_path, exist_ok=True)
+    datedf.to_csv(taxi_date_path + "taxi_data_" + aggregate.month + ".csv", encoding="utf-8")
+
+    # taxi_data/by_day/taxi_data_YYYY-MM.npz, day x {yellow, green} x zone
+    os.makedirs(taxi_day_path, exist_ok=True)
+    np.savez(taxi_day_path + "taxi_data_" + aggregate.month + ".npz",
+             dates=aggregate.start + np.arange(aggregate.ndays),
+             location_ids=location_ids,
+             trips=aggregate.trips[:, :, 1:].transpose(1, 0, 2),
+             revenue=aggregate.revenue[:, :, 1:].transpose(1, 0, 2))
+
+def zone_rows(paths, zones):
+    # rows of the by_zone files from the given by_date files
+    dfs = []
+    for path in sorted(paths):
+        match = re.search(r"taxi_data_(\d{4})-(\d{2})\.csv$", path)
+        if match:
+            df = pd.read_csv(path, index_col=0)
+            df["year"] = int(match.group(1))
+            df["month"] = int(match.group(2))
+            dfs.append(df)
+    totaldf = pd.concat(dfs).reset_index()
+    totaldf["day"] = 1
+    totaldf["date"] = pd.to_datetime(totaldf[["year", "month", "day"]])
+    totaldf["zone_name"] = totaldf["location_id"].map(zones["Zone"])
+    columns = ["index", "taxi_type", "num_trips", "total_cost", "year", "month",
+               "location_id", "day", "date", "zone_name"]
+    return totaldf[columns]
+
+def write_zone(location_id, zonedf, append=False):
+    path = taxi_zone_path + "taxi_data_" + str(location_id) + ".csv"
+    if append and os.path.exists(path):
+        # continues the row numbers of the file
+        with open(path) as f:
+            nrows = sum(1 for line in f) - 1
+        zonedf.set_axis(range(nrows, nrows + len(zonedf))).to_csv(
+            path, mode="a", header=False, encoding="utf-8")
+    else:
+        zonedf.reset_index(drop=True).to_csv(path, encoding="utf-8")
+
+def write_zones(zones, executor):
+    # taxi_data/by_zone/taxi_data_<location_id>.csv, the monthly series of
+    # each zone, from all the by_date files, written by the workers
+    os.makedirs(taxi_zone_path, exist_ok=True)
+    groups = zone_rows(glob.glob(taxi_date_path + "taxi_data_*.csv"), zones).groupby("location_id")
+    # consumes the results so that errors of the workers are raised here
+    list(executor.map(write_zone, *zip(*groups), chunksize=16))
+
+def append_zones(months, zones, executor):
+    # appends the rows of months to the by_zone files, which must not have them
+    os.makedirs(taxi_zone_path, exist_ok=True)
+    paths = [taxi_date_path + "taxi_data_" + month + ".csv" for month in months]
+    groups = list(zone_rows(paths, zones).groupby("location_id"))
+    list(executor.map(write_zone, *zip(*groups), [True] * len(groups), chunksize=16))
+
+def ingest(months, workers=None, update=False):
+    # workers defaults to the number of cores. update only adds the months to
+    # the by_zone files and the store: by_zone rows of months that follow the
+    # last month of the store are appended, the files are rewritten otherwise
+    zones = pd.read_csv(zone_lookup_path).set_index("LocationID", drop=False)
+    stored = datastore.load().months.tolist() if update else []
+    # the months must fit the store before any file is written
+    if update:
+        datastore.updated_months(months, stored)
+    with ProcessPoolExecutor(workers) as executor:
+        aggregates = aggregate_months(months, len(zones), executor)
+        # and still fit it without the months that have no raw data
+        if update:
+            datastore.updated_months(aggregates, stored)
+        for month, aggregate in aggregates.items():
+            if aggregate.skipped:
+                print("skipped {} trips outside of {} or of the taxi zones".format(
+                    aggregate.skipped, month))
+            write_month(aggregate, zones)
+        months = sorted(aggregates)
+        if not months:
+            return
+        if update and stored and months[0] > stored[-1]:
+            append_zones(months, zones, executor)
+        else:
+            write_zones(zones, executor)
+    if update:
+        datastore.update_months(months)
+    else:
+        datastore.build()
+
+# main
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    workers = None
+    if args[:1] == ["-j"]:
+        workers, args = int(args[1]), args[2:]
+    update = args[:1] == ["--update"]
+    ingest(args[1:] if update else args, workers, update)
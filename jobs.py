@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Local queue of the background jobs of the callbacks, run by a thread pool
+# of the worker process, without any broker. A job is identified by a key
+# (its arguments), submitting a key that is queued or running joins that
+# job. Each client (browser page) has one current job: when it submits
+# another, its previous job is cancelled unless another client waits for it,
+# before it starts, or once running at the checks of cancelled(). The
+# results are not kept here, the jobs store them in the shared caches where
+# the callbacks polling for them find them.
+
+max_clients = 1024
+
+class JobQueue:
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="jobs")
+        # reentrant, cancelling a future runs its done callback right away
+        self.lock = threading.RLock()
+        # key -> future of the queued, running and failed jobs
+        self.jobs = {}
+        # client -> key of its current job, the least recent first
+        self.clients = OrderedDict()
+
+    def submit(self, client, key, func, *args):
+        # future of the job key of client, func(*args) is submitted unless
+        # the job is already queued or running, or failed and client was
+        # already waiting for it
+        with self.lock:
+            previous = self.clients.pop(client, None)
+            self.clients[client] = key
+            while len(self.clients) > max_clients:
+                self._release(self.clients.popitem(last=False)[1])
+            if previous is not None and previous != key:
+                self._release(previous)
+            future = self.jobs.get(key)
+            if future is None or (previous != key and future.done()):
+                future = self.executor.submit(func, *args)
+                self.jobs[key] = future
+                future.add_done_callback(lambda future: self._done(key, future))
+            return future
+
+    def finish(self, client):
+        # client waits for no job anymore
+        with self.lock:
+            key = self.clients.pop(client, None)
+            if key is not None:
+                self._release(key)
+
+    def cancelled(self, key):
+        # whether no client waits for the job key anymore
+        with self.lock:
+            return key not in self.clients.values()
+
+    def _release(self, key):
+        # cancels the job key if no client waits for it, the lock is held
+        if key in self.clients.values():
+            return
+        future = self.jobs.pop(key, None)
+        if future is not None:
+            future.cancel()
+
+    def _done(self, key, future):
+        # finished jobs are dropped, their results are in the caches, the
+        # failed ones are kept until their clients move on so that the
+        # polling stops
+        if future.cancelled() or future.exception() is None:
+            with self.lock:
+                if self.jobs.get(key) is future:
+                    del self.jobs[key]
@@ -0,0 +1,221 @@
+import contextlib
+import functools
+import hmac
+import os
+import threading
+import time
+from collections import deque
+
+import flask
+import numpy as np
+
+# Timings of the dashboard callbacks, per worker process. Every callback
+# request records its wall time, from the request to the response, the time
+# of its stages (the callback itself, the stage() blocks it runs and the
+# serialization of its result by Dash) and the size of its response. The
+# stages do not overlap: the time of a stage() block is not counted in the
+# callback or the stage() block it runs in, so that they add up to the wall
+# time but for the handling of the request around them. The last samples of
+# each callback are summarized with the hit rates of the caches at /metrics
+# (see metrics_allowed). The jobs run in the background, outside of any
+# request, are recorded the same way with their stages, under their own name
+# and with no response size.
+#
+# PROFILE=cprofile (or pyinstrument, if installed) also profiles every
+# callback request into PROFILE_PATH (profiles/ by default), one file per
+# request, .prof for cProfile (python -m pstats) and .html for pyinstrument.
+
+samples = 1000
+update_path = "/_dash-update-component"
+# stages of the job the current thread runs, if any
+_job = threading.local()
+
+def _stages():
+    # stage times of the current callback request or job, and the time of
+    # the stages nested in each running stage, None if there is neither
+    if flask.has_request_context():
+        return flask.g.setdefault("metric_stages", {}), flask.g.setdefault("metric_nested", [])
+    if getattr(_job, "stages", None) is not None:
+        return _job.stages, _job.nested
+    return None, None
+
+@contextlib.contextmanager
+def _exclusive(stages, nested, name):
+    # adds the time of the block to the stage name, but for the time of the
+    # stages nested in it, which count it themselves
+    nested.append(0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stages[name] = stages.get(name, 0) + elapsed - nested.pop()
+        if nested:
+            nested[-1] += elapsed
+
+@contextlib.contextmanager
+def stage(name):
+    # times the block as a stage of the current callback request or job, if
+    # any
+    stages, nested = _stages()
+    if stages is None:
+        yield
+        return
+    with _exclusive(stages, nested, name):
+        yield
+
+@contextlib.contextmanager
+def timed_job(metrics, name):
+    # times the block as a background job recorded under name in metrics
+    # (returned by instrument), with the stage() blocks it runs
+    _job.stages, _job.nested = stages, nested = {}, []
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _job.stages = _job.nested = None
+        metrics.record(name, time.perf_counter() - start, 0, stages)
+
+def timed(func):
+    # marks func as a callback whose requests are recorded under its name,
+    # the time after it returns is the serialization of its result
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not flask.has_request_context():
+            return func(*args, **kwargs)
+        flask.g.metric_callback = func.__name__
+        try:
+            with _exclusive(*_stages(), "callback"):
+                return func(*args, **kwargs)
+        finally:
+            flask.g.metric_callback_end = time.perf_counter()
+    return wrapper
+
+class CallbackMetrics:
+    # last samples of each callback: wall time, stage times and response size
+    def __init__(self, caches=None):
+        self.caches = caches or {}
+        self.lock = threading.Lock()
+        self.callbacks = {}
+        self.counts = {}
+
+    def record(self, callback, seconds, nbytes, stages):
+        with self.lock:
+            if callback not in self.callbacks:
+                self.callbacks[callback] = deque(maxlen=samples)
+                self.counts[callback] = 0
+            self.callbacks[callback].append((seconds, nbytes, stages))
+            self.counts[callback] += 1
+
+    def summary(self):
+        with self.lock:
+            callbacks = {name : list(records) for name, records in self.callbacks.items()}
+            counts = dict(self.counts)
+        summary = {"pid": os.getpid(), "callbacks": {}, "caches": {}}
+        for name, records in callbacks.items():
+            seconds = np.array([record[0] for record in records]) * 1000
+            nbytes = np.array([record[1] for record in records])
+            stage_names = sorted({stage for record in records for stage in record[2]})
+            summary["callbacks"][name] = {
+                "count": counts[name],
+                "ms": dict(zip(["mean", "p50", "p90", "p99", "max"],
+                               [seconds.mean()] + np.percentile(seconds, [50, 90, 99, 100]).tolist())),
+                "stages_mean_ms": {stage : sum(record[2].get(stage, 0) for record in records)
+                                           / len(records) * 1000 for stage in stage_names},
+                "bytes": {"mean": nbytes.mean(), "max": int(nbytes.max())},
+            }
+        for name, cache in self.caches.items():
+            summary["caches"][name] = cache_summary(cache.stats())
+        return summary
+
+def cache_summary(stats):
+    # stats of a cache with the hit rate of each level
+    if "hits" in stats:
+        lookups = stats["hits"] + stats["misses"]
+        return dict(stats, hit_rate=stats["hits"] / lookups if lookups else None)
+    return {level : cache_summary(level_stats) for level, level_stats in stats.items()}
+
+def _start_profiler(profiler):
+    if profiler == "cprofile":
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        return profile
+    raise ValueError("PROFILE must be cprofile or pyinstrument, not {}".format(profiler))
+
+def _stop_profiler(profile, callback):
+    path = os.environ.get("PROFILE_PATH", "profiles/")
+    os.makedirs(path, exist_ok=True)
+    name = os.path.join(path, "{}-{}-{}".format(callback, time.strftime("%Y%m%d-%H%M%S"),
+                                                time.perf_counter_ns() % 10**6))
+    if hasattr(profile, "dump_stats"):
+        profile.disable()
+        profile.dump_stats(name + ".prof")
+    else:
+        profile.stop()
+        with open(name + ".html", "w") as f:
+            f.write(profile.output_html())
+
+def metrics_allowed(request):
+    # whether request may read /metrics: with METRICS_TOKEN set it must carry
+    # the token, as "Authorization: Bearer <token>" or a token parameter, and
+    # with METRICS_ALLOW set come from one of its comma-separated addresses.
+    # With neither, only the local host may, which behind a local reverse
+    # proxy is every client
+    token = os.environ.get("METRICS_TOKEN")
+    allowed = os.environ.get("METRICS_ALLOW")
+    if token is None and allowed is None:
+        return request.remote_addr in ("127.0.0.1", "::1")
+    if token is not None:
+        authorization = request.headers.get("Authorization", "")
+        given = authorization[len("Bearer "):] if authorization.startswith("Bearer ") \
+                    else request.args.get("token", "")
+        if not hmac.compare_digest(given.encode(), token.encode()):
+            return False
+    if allowed is not None:
+        return request.remote_addr in [address.strip() for address in allowed.split(",")]
+    return True
+
+def instrument(app, caches=None):
+    # records the callback requests of the Dash app and serves the summary
+    # at /metrics, caches maps names to the caches to report
+    metrics = CallbackMetrics(caches)
+    server = app.server
+    profiler = os.environ.get("PROFILE")
+
+    @server.before_request
+    def start_request():
+        if flask.request.path.endswith(update_path):
+            flask.g.metric_start = time.perf_counter()
+            if profiler:
+                flask.g.metric_profile = _start_profiler(profiler)
+
+    @server.after_request
+    def record_request(response):
+        start = flask.g.get("metric_start")
+        callback = flask.g.get("metric_callback")
+        if start is None:
+            return response
+        end = time.perf_counter()
+        if "metric_profile" in flask.g:
+            _stop_profiler(flask.g.metric_profile, callback or "request")
+        if callback is None:
+            return response
+        stages = dict(flask.g.get("metric_stages", {}))
+        stages["serialization"] = end - flask.g.metric_callback_end
+        nbytes = response.calculate_content_length() or 0
+        metrics.record(callback, end - start, nbytes, stages)
+        return response
+
+    @server.route("/metrics")
+    def serve_metrics():
+        if not metrics_allowed(flask.request):
+            flask.abort(403)
+        return flask.jsonify(metrics.summary())
+
+    return metrics
@@ -0,0 +1,110 @@
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Taxi zone <-> zip code overlap, as two adjacency indexes built once at
+# startup, so that selections are resolved without scanning the overlap table.
+# The overlap table itself is computed from the zone and zip geometries with a
+# spatial index, which needs shapely. Its area shares are only used to leave
+# out the slivers (see min_share), no value is apportioned by area:
+#
+#   python overlap.py [taxi_zones.geojson zip_codes.geojson overlap.csv]
+
+taxi_zone_path = "map_data/taxi_zones.geojson"
+zip_code_path = "map_data/zip_codes.geojson"
+overlap_path = "map_data/taxi_zip_overlap.csv"
+# pairs covering less than this share of both the zone and the zip are
+# slivers of the boundaries drawn slightly apart, not an overlap, which the
+# selections leave out (see the README for how that changed them)
+min_share = 0.01
+
+class Adjacency:
+    # CSR-style adjacency from keys to the values they are paired with, the
+    # values of a key keep the order of the pairs
+    def __init__(self, keys, values):
+        keys = np.asarray(keys)
+        order = np.argsort(keys, kind="stable")
+        self.values = np.asarray(values)[order]
+        self.keys, starts = np.unique(keys[order], return_index=True)
+        self.offsets = np.append(starts, len(self.values))
+        self.rows = {key : row for row, key in enumerate(self.keys.tolist())}
+
+    def __getitem__(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            return self.values[:0]
+        return self.values[self.offsets[row]:self.offsets[row + 1]]
+
+    def union(self, keys):
+        # values of all keys, without duplicates, in order of first appearance
+        values = np.concatenate([self[key] for key in keys]) if keys else self.values[:0]
+        return pd.unique(values).tolist()
+
+class OverlapIndex:
+    # location_ids[k] and zip_codes[k] are a taxi zone and a zip code that
+    # overlap
+    def __init__(self, location_ids, zip_codes):
+        self.location_ids = np.asarray(location_ids)
+        self.zip_codes = np.asarray(zip_codes)
+        self.zone_zips = Adjacency(location_ids, zip_codes)
+        self.zip_zones = Adjacency(zip_codes, location_ids)
+
+    def zips_for_zones(self, location_ids):
+        return self.zone_zips.union(location_ids)
+
+    def zones_for_zips(self, zip_codes):
+        return self.zip_zones.union(zip_codes)
+
+def _features(path, id_property):
+    # {id: geometry} of the features of a geojson file, features sharing an
+    # id (zones split into several records) are merged into one geometry
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+
+    with open(path) as f:
+        features = json.load(f)["features"]
+    parts = {}
+    for feature in features:
+        geometry = shape(feature["geometry"])
+        if not geometry.is_valid:
+            geometry = geometry.buffer(0)
+        parts.setdefault(feature["properties"][id_property], []).append(geometry)
+    return {key : geometries[0] if len(geometries) == 1 else unary_union(geometries)
+            for key, geometries in parts.items()}
+
+def compute_overlap(zone_path=taxi_zone_path, zip_path=zip_code_path):
+    # pairs of intersecting taxi zones and zip codes, found through an STRtree
+    # of the zip bounding boxes, with their intersection area and the share of
+    # the zone and of the zip it covers
+    # areas are in squared degrees, only their ratios are meaningful
+    from shapely.strtree import STRtree
+
+    zones = _features(zone_path, "LocationID")
+    zips = _features(zip_path, "postalCode")
+    zip_codes = list(zips)
+    zip_shapes = [zips[zip_code] for zip_code in zip_codes]
+    tree = STRtree(zip_shapes)
+
+    rows = []
+    for location_id, zone in zones.items():
+        for j in sorted(tree.query(zone, predicate="intersects")):
+            area = zone.intersection(zip_shapes[j]).area
+            rows.append((int(location_id), int(zip_codes[j]), area,
+                         area / zone.area if zone.area else 0.0,
+                         area / zip_shapes[j].area if zip_shapes[j].area else 0.0))
+    return pd.DataFrame(rows, columns=["LocationID", "zip_code", "area",
+                                       "zone_share", "zip_share"])
+
+def load_overlap(path=overlap_path, min_share=min_share):
+    # overlap index of a table, without its slivers if it has the area shares
+    overlapdf = pd.read_csv(path)
+    if "zone_share" in overlapdf and "zip_share" in overlapdf:
+        overlapdf = overlapdf[(overlapdf["zone_share"] >= min_share) | (overlapdf["zip_share"] >= min_share)]
+    return OverlapIndex(overlapdf["LocationID"].to_numpy(), overlapdf["zip_code"].to_numpy())
+
+# main
+if __name__ == "__main__":
+    paths = sys.argv[1:4] if len(sys.argv) > 3 else [taxi_zone_path, zip_code_path, overlap_path]
+    compute_overlap(paths[0], paths[1]).to_csv(paths[2], encoding="utf-8", index=False)
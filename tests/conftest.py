@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules are at the root of the repository and open their data files
+# relative to it
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.chdir(root)
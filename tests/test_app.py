@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# the app is imported without its warmup thread, with caches of its own
+os.environ["WARMUP"] = "0"
+os.environ["CACHE_PATH"] = tempfile.mkdtemp()
+
+import app
+from cube import PrefixCube
+
+def fake_data(build, nmonths, value):
+    # the arrays of DashboardData the frames are computed from, value in
+    # every month of 2 zones and 3 zips
+    return SimpleNamespace(
+        build=build,
+        taxicube=PrefixCube(np.full((nmonths, 2, 2), value)),
+        taxi_attributes=pd.DataFrame({"PULocationID": [1, 2], "Borough": ["a", "b"],
+                                      "Zone": ["a", "b"], "service_zone": ["a", "b"]}),
+        covidcube=PrefixCube(np.full((nmonths, 3), value)),
+        covid_zips=np.array([10001, 10002, 10003]))
+
+@pytest.fixture
+def stale_worker(monkeypatch):
+    # a worker that loaded the build "old" of 24 months and checked the store
+    # just before it was updated to the build "new" of 25 months
+    old, new = fake_data("old", 24, 1.0), fake_data("new", 25, 2.0)
+    monkeypatch.setattr(app, "data", old)
+    monkeypatch.setattr(app, "data_checked", time.monotonic())
+    monkeypatch.setattr(app.datastore, "store_build_at", lambda path: "new")
+    monkeypatch.setattr(app.datastore, "DataStore", lambda: None)
+    monkeypatch.setattr(app, "DashboardData", lambda store: new)
+    app.current_frames.clear()
+    yield new
+    app.current_frames.clear()
+
+def test_frames_of_a_new_build_before_the_refresh(stale_worker):
+    # the month 24 only exists in the new build
+    taxidf = app.get_current_taxidf("new", 24, 24, False)
+    coviddf = app.get_current_coviddf("new", 0, 0, False)
+    assert app.data is stale_worker
+    assert taxidf["yellow_total_amount"].tolist() == [2.0, 2.0]
+    assert coviddf["hospitalization_rate"].tolist() == [2.0, 2.0, 2.0]
+    # the other workers find the frame of the new data in the shared cache
+    shared = app.current_frames.shared.get(("get_current_coviddf", "new", 0, 0, False))
+    assert shared["hospitalization_rate"].tolist() == [2.0, 2.0, 2.0]
+
+def test_frames_of_a_replaced_build(stale_worker):
+    app.get_current_coviddf("new", 0, 0, False)
+    with pytest.raises(app.StaleBuild):
+        app.get_current_coviddf("old", 0, 0, False)
+    assert not app.get_current_coviddf.cached("old", 0, 0, False)
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from cache import LRUCache, FileCache, TieredCache, memoize
+
+def test_lru_cache_evicts_the_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["hits"] == 3
+
+def entry_size(tmp_path):
+    # size of the file of an entry of 1000 bytes
+    cache = FileCache(str(tmp_path / "size"))
+    cache.set("size", b"x" * 1000)
+    return os.path.getsize(cache.entry_path("size"))
+
+def test_file_cache_evicts_the_least_recently_used(tmp_path):
+    size = entry_size(tmp_path)
+    cache = FileCache(str(tmp_path / "cache"), maxbytes=2 * size)
+    cache.set("a", b"a" * 1000)
+    cache.set("b", b"b" * 1000)
+    # explicit times, the entries are ordered by them
+    os.utime(cache.entry_path("a"), (1, 1))
+    os.utime(cache.entry_path("b"), (2, 2))
+    # reading a makes it the most recent
+    assert cache.get("a") == b"a" * 1000
+    cache.set("c", b"c" * 1000)
+    assert cache.get("b") is None
+    assert cache.get("a") == b"a" * 1000 and cache.get("c") == b"c" * 1000
+    assert cache.stats()["bytes"] <= cache.maxbytes
+
+def test_file_cache_is_shared_by_path(tmp_path):
+    FileCache(str(tmp_path)).set(("key", 1), [1, 2])
+    other = FileCache(str(tmp_path))
+    assert other.get(("key", 1)) == [1, 2]
+    assert other.get(("key", 2)) is None
+
+def test_file_cache_drops_a_broken_entry(tmp_path):
+    cache = FileCache(str(tmp_path))
+    cache.set("a", 1)
+    with open(cache.entry_path("a"), "wb") as f:
+        f.write(b"not a pickle")
+    assert cache.get("a", "missing") == "missing"
+    assert "a" not in cache
+
+def test_tiered_cache_keeps_shared_values_locally(tmp_path):
+    FileCache(str(tmp_path)).set("a", 1)
+    cache = TieredCache(LRUCache(), FileCache(str(tmp_path)))
+    assert cache.get("a") == 1
+    assert "a" in cache.local
+
+def test_memoize_caches_nothing_when_the_function_raises(tmp_path):
+    calls = []
+
+    @memoize(TieredCache(LRUCache(), FileCache(str(tmp_path))))
+    def square(x):
+        calls.append(x)
+        if x < 0:
+            raise ValueError(x)
+        return x * x
+
+    assert square(3) == 9 and square(3) == 9
+    assert calls == [3]
+    with pytest.raises(ValueError):
+        square(-1)
+    assert not square.cached(-1)
+    assert square.cached(3)
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cube import PrefixCube, DateCube
+
+def test_prefix_cube_range_sum_and_mean():
+    values = np.arange(24, dtype=np.float64).reshape(6, 2, 2)
+    cube = PrefixCube(values)
+    assert cube.nperiods == 6
+    assert np.array_equal(cube.range_sum(1, 3), values[1:4].sum(axis=0))
+    assert np.array_equal(cube.range_sum(5, 5), values[5])
+    assert np.array_equal(cube.range_mean(0, 5), values.mean(axis=0))
+
+def test_prefix_cube_range_outside_of_the_periods():
+    cube = PrefixCube(np.ones((3, 2)))
+    for start, end in [(-1, 1), (0, 3), (2, 1)]:
+        with pytest.raises(ValueError):
+            cube.range_sum(start, end)
+
+@pytest.fixture
+def days():
+    # two zones over march and april 2020, a third of the days missing
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2020-03-01", "2020-04-30", freq="D")
+    dates = dates[rng.random(len(dates)) < 2 / 3]
+    return pd.DataFrame(rng.integers(0, 100, (len(dates), 2)).astype(np.float64), index=dates)
+
+@pytest.mark.parametrize("freq, period", [("D", "D"), ("W", "W-SUN"), ("M", "M")])
+def test_date_cube_rollup_is_the_sums_of_the_periods(days, freq, period):
+    # from a wednesday, the first week and month only have part of their days
+    start, end = "2020-03-11", "2020-04-20"
+    cube = DateCube(days.index.values, days.values)
+    periods, sums = cube.rollup(start, end, freq)
+    selected = days[start:end]
+    labels = np.maximum(selected.index.to_period(period).start_time.values, np.datetime64(start))
+    expected = selected.groupby(labels).sum()
+    assert np.array_equal(periods, expected.index.values.astype("datetime64[D]"))
+    assert np.array_equal(sums, expected.values)
+
+def test_date_cube_rollup_of_days_without_data():
+    cube = DateCube(np.array(["2020-03-02", "2020-03-20"], dtype="datetime64[D]"), np.ones((2, 1)))
+    periods, sums = cube.rollup("2020-03-03", "2020-03-19", "W")
+    assert len(periods) == 0 and sums.shape == (0, 1)
+    periods, sums = cube.rollup("2020-03-01", "2020-03-31", "W")
+    assert periods.tolist() == np.array(["2020-03-02", "2020-03-16"], dtype="datetime64[D]").tolist()
+    assert sums.tolist() == [[1.0], [1.0]]
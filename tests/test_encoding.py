@@ -0,0 +1,71 @@
+import base64
+import copy
+
+import numpy as np
+
+from encoding import encode_array, encode_figure, min_length
+
+def decode(encoded):
+    # values of an encoded array, as assets/arrays.js decodes them
+    if encoded["dtype"] == "columns":
+        columns = [decode(column) for column in encoded["columns"]]
+        return [list(row) for row in zip(*columns)]
+    if encoded["dtype"] == "str":
+        return [encoded["strings"][i] for i in decode(encoded["index"])]
+    return np.frombuffer(base64.b64decode(encoded["bdata"]), dtype="<" + encoded["dtype"]).tolist()
+
+def test_integers_as_int16_or_int32():
+    small = list(range(-100, 100))
+    encoded = encode_array(small)
+    assert encoded["dtype"] == "i2" and decode(encoded) == small
+    large = [i * 100000 for i in range(-50, 50)]
+    encoded = encode_array(np.array(large))
+    assert encoded["dtype"] == "i4" and decode(encoded) == large
+
+def test_integers_beyond_int32_are_left_as_they_are():
+    values = np.array([2**31 + i for i in range(20)])
+    assert encode_array(values) is values
+
+def test_floats_as_float64_or_float32():
+    values = np.linspace(0, 1, 50) / 3
+    encoded = encode_array(values)
+    assert encoded["dtype"] == "f8" and decode(encoded) == values.tolist()
+    encoded = encode_array(values, float32=True)
+    assert encoded["dtype"] == "f4"
+    assert decode(encoded) == values.astype(np.float32).tolist()
+
+def test_strings_as_a_table():
+    values = ["Queens", "Bronx", None, "Queens", float("nan")] * 10
+    encoded = encode_array(values)
+    assert encoded["dtype"] == "str" and encoded["strings"] == ["Queens", "Bronx", None]
+    assert decode(encoded) == [None if value != value else value for value in values]
+
+def test_customdata_by_columns():
+    values = [[i, "zone {}".format(i % 3), i / 7] for i in range(30)]
+    encoded = encode_array(values)
+    assert [column["dtype"] for column in encoded["columns"]] == ["i2", "str", "f8"]
+    assert decode(encoded) == values
+
+def test_short_and_other_arrays_are_left_as_they_are():
+    short = list(range(min_length - 1))
+    assert encode_array(short) is short
+    mixed = ["a", 1] * 100
+    assert encode_array(mixed) is mixed
+    ragged = [[1, 2], [3]] * 10
+    assert encode_array(ragged) is ragged
+
+def test_encode_figure_keeps_the_figure():
+    figure = {"data": [{"type": "choroplethmapbox", "locations": list(range(100)),
+                        "z": np.arange(100) / 3, "name": "zones",
+                        "marker": {"color": list(np.arange(100) / 3), "opacity": 0.5}}],
+              "layout": {"title": "taxis"}}
+    original = copy.deepcopy(figure)
+    encoded = encode_figure(figure)
+    trace = encoded["data"][0]
+    assert trace["locations"]["dtype"] == "i2"
+    assert trace["z"]["dtype"] == "f4" and trace["marker"]["color"]["dtype"] == "f4"
+    assert trace["name"] == "zones" and trace["marker"]["opacity"] == 0.5
+    assert encoded["layout"] is figure["layout"]
+    assert figure["data"][0]["locations"] == original["data"][0]["locations"]
+    assert np.array_equal(figure["data"][0]["z"], original["data"][0]["z"])
+    assert figure["data"][0]["marker"]["color"] == original["data"][0]["marker"]["color"]
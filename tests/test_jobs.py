@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from jobs import JobQueue
+
+@pytest.fixture
+def queue():
+    # one worker, busy with a job that runs until blocker is set
+    queue = JobQueue(workers=1)
+    queue.blocker = threading.Event()
+    queue.started = threading.Event()
+
+    def block():
+        queue.started.set()
+        queue.blocker.wait(5)
+
+    queue.submit("busy", "blocking", block)
+    assert queue.started.wait(5)
+    yield queue
+    queue.blocker.set()
+    queue.executor.shutdown(wait=True)
+
+def test_same_key_joins_the_job(queue):
+    first = queue.submit("a", ("job", 1), lambda: 1)
+    assert queue.submit("b", ("job", 1), lambda: 2) is first
+    queue.blocker.set()
+    assert first.result(5) == 1
+
+def test_queued_job_is_cancelled_when_replaced(queue):
+    first = queue.submit("a", ("job", 1), lambda: 1)
+    second = queue.submit("a", ("job", 2), lambda: 2)
+    assert first.cancelled()
+    queue.blocker.set()
+    assert second.result(5) == 2
+
+def test_job_of_another_client_is_kept(queue):
+    first = queue.submit("a", ("job", 1), lambda: 1)
+    queue.submit("b", ("job", 1), lambda: 1)
+    queue.submit("a", ("job", 2), lambda: 2)
+    assert not first.cancelled() and not queue.cancelled(("job", 1))
+    queue.blocker.set()
+    assert first.result(5) == 1
+
+def test_running_job_sees_it_is_cancelled(queue):
+    # the blocking job is running, its client moves on
+    assert not queue.cancelled("blocking")
+    queue.submit("busy", ("job", 1), lambda: 1)
+    assert queue.cancelled("blocking")
+
+def test_finish_releases_the_job(queue):
+    first = queue.submit("a", ("job", 1), lambda: 1)
+    queue.finish("a")
+    assert first.cancelled() and queue.cancelled(("job", 1))
+    # submitted again, the key is a new job
+    second = queue.submit("a", ("job", 1), lambda: 2)
+    assert second is not first
+    queue.blocker.set()
+    assert second.result(5) == 2
+
+def test_failed_job_is_kept_until_its_client_moves_on(queue):
+    def fail():
+        raise ValueError("failed")
+
+    queue.blocker.set()
+    failed = queue.submit("a", ("job", 1), fail)
+    with pytest.raises(ValueError):
+        failed.result(5)
+    # polling the same job does not run it again
+    assert queue.submit("a", ("job", 1), fail) is failed
+    queue.finish("a")
+    assert queue.submit("a", ("job", 1), lambda: 1).result(5) == 1
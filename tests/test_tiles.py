@@ -0,0 +1,176 @@
+import json
+
+import numpy as np
+import pytest
+
+import tiles
+
+# The tiles are checked with a decoder of the protobuf wire format and of the
+# geometry commands written here from the Mapbox vector tile specification,
+# and with mapbox_vector_tile if it is installed.
+
+def read_varint(data, i):
+    value = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, i
+
+def read_message(data):
+    # [(field, value)] of a message with varint and length-delimited fields
+    fields = []
+    i = 0
+    while i < len(data):
+        tag, i = read_varint(data, i)
+        if tag & 7 == 0:
+            value, i = read_varint(data, i)
+        elif tag & 7 == 2:
+            length, i = read_varint(data, i)
+            value, i = data[i:i + length], i + length
+        else:
+            raise ValueError("unexpected wire type {}".format(tag & 7))
+        fields.append((tag >> 3, value))
+    return fields
+
+def read_packed(data):
+    values = []
+    i = 0
+    while i < len(data):
+        value, i = read_varint(data, i)
+        values.append(value)
+    return values
+
+def read_geometry(commands):
+    # rings of the geometry commands, with their closing point
+    rings = []
+    x = y = 0
+    i = 0
+    while i < len(commands):
+        command, count = commands[i] & 7, commands[i] >> 3
+        i += 1
+        if command == 7:
+            rings[-1].append(rings[-1][0])
+            continue
+        for _ in range(count):
+            dx, dy = commands[i], commands[i + 1]
+            x += (dx >> 1) ^ -(dx & 1)
+            y += (dy >> 1) ^ -(dy & 1)
+            i += 2
+            if command == 1:
+                rings.append([])
+            rings[-1].append((x, y))
+    return rings
+
+def read_tile(data):
+    # {layer name: {"version", "extent", "features": {id: (type, rings)}}}
+    layers = {}
+    for field, layer in read_message(data):
+        assert field == 3
+        fields = read_message(layer)
+        name = [value for field, value in fields if field == 1][0].decode()
+        features = {}
+        for field, feature in fields:
+            if field == 2:
+                values = dict(read_message(feature))
+                features[values[1]] = (values[3], read_geometry(read_packed(values[4])))
+        layers[name] = {"version": [value for field, value in fields if field == 15][0],
+                        "extent": [value for field, value in fields if field == 5][0],
+                        "features": features}
+    return layers
+
+def signed_area(ring):
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring, ring[1:])) / 2
+
+# a square with a square hole and a triangle, in tile coordinates
+square = [[(0, 0), (100, 0), (100, 100), (0, 100)], [(25, 25), (25, 75), (75, 75), (75, 25)]]
+triangle = [[(200, 200), (300, 200), (200, 300)]]
+
+def tile_index(features):
+    # TileIndex of one stored tile at (tile_maxzoom, 3, 5) with the features
+    # {id: rings}
+    index = tiles.TileIndex.__new__(tiles.TileIndex)
+    packed = [tiles._varints(tiles.encode_rings(rings)) for rings in features.values()]
+    index.tile_keys = np.array([tiles.tile_key(tiles.tile_maxzoom, 3, 5)])
+    index.tile_offsets = np.array([0, len(features)])
+    index.feature_ids = np.array(list(features))
+    index.geometry_offsets = np.cumsum([0] + [len(geometry) for geometry in packed])
+    index.geometry = np.frombuffer(b"".join(packed), dtype=np.uint8)
+    return index
+
+def test_tile_has_the_features_of_the_ids():
+    index = tile_index({7: square, 11: triangle})
+    layers = read_tile(index.tile(tiles.tile_maxzoom, 3, 5, {7, 99}, "boundaries"))
+    layer = layers["boundaries"]
+    assert layer["version"] == 2 and layer["extent"] == tiles.extent
+    assert list(layer["features"]) == [7]
+    geometry_type, rings = layer["features"][7]
+    # polygon
+    assert geometry_type == 3
+    assert [ring[:-1] for ring in rings] == square
+
+def test_tile_without_features():
+    index = tile_index({7: square})
+    assert index.tile(tiles.tile_maxzoom, 3, 5, {11}, "boundaries") == b""
+    assert index.tile(tiles.tile_maxzoom, 3, 6, {7}, "boundaries") == b""
+    assert index.tile(2, 4, 0, {7}, "boundaries") == b""
+
+def test_tile_above_the_stored_zooms_is_scaled():
+    index = tile_index({11: triangle})
+    # the lower right quarter of the stored tile
+    tile = index.tile(tiles.tile_maxzoom + 1, 7, 11, {11}, "boundaries")
+    rings = read_tile(tile)["boundaries"]["features"][11][1]
+    assert rings[0][:-1] == [(2 * x - tiles.extent, 2 * y - tiles.extent) for x, y in triangle[0]]
+
+def test_polygon_rings_are_oriented():
+    shapely = pytest.importorskip("shapely")
+    # exterior counterclockwise and hole clockwise with y pointing down, the
+    # reverse of the tile format
+    polygon = shapely.Polygon([(0, 0), (0, 100), (100, 100), (100, 0)],
+                              [[(25, 25), (75, 25), (75, 75), (25, 75)]])
+    exterior, hole = tiles._polygon_rings(polygon)
+    assert signed_area(exterior + exterior[:1]) == 100 * 100
+    assert signed_area(hole + hole[:1]) == -50 * 50
+
+def test_flat_polygon_is_left_out():
+    shapely = pytest.importorskip("shapely")
+    assert tiles._polygon_rings(shapely.Polygon([(0, 0), (10, 0), (20, 0), (10, 0)])) == []
+
+def test_map_tiles_of_a_zone(tmp_path):
+    pytest.importorskip("shapely")
+    # a zone of 0.01 degree, about 3.6 units of the tiles of zoom 5 and 0.1
+    # of the tile of zoom 0
+    lon, lat = -73.97, 40.7
+    path = tmp_path / "zones.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [{
+        "type": "Feature", "properties": {"LocationID": 4},
+        "geometry": {"type": "Polygon", "coordinates": [[
+            [lon, lat], [lon + 0.01, lat], [lon + 0.01, lat + 0.01], [lon, lat + 0.01], [lon, lat]]]}}]}))
+    columns = tiles.map_tiles(str(path), "LocationID")
+    assert columns["point_ids"].tolist() == [4]
+    assert np.allclose(columns["point_lonlat"], [[lon + 0.005, lat + 0.005]], atol=0.005)
+    index = tiles.TileIndex.__new__(tiles.TileIndex)
+    for name in tiles.tile_columns:
+        setattr(index, name, columns[name])
+    # the tile of the center of the zone has it from zoom 5, and zoom 0
+    # leaves it out with its area rounded to nothing
+    for z in range(5, tiles.tile_maxzoom + 1):
+        x, y = tiles.world(lon + 0.005, lat + 0.005, z)
+        rings = read_tile(index.tile(z, int(x), int(y), {4}, "boundaries"))["boundaries"]["features"][4][1]
+        assert len(rings) == 1 and signed_area(rings[0]) > 0
+    assert index.tile(0, 0, 0, {4}, "boundaries") == b""
+
+def test_tile_with_reference_decoder():
+    mapbox_vector_tile = pytest.importorskip("mapbox_vector_tile")
+    index = tile_index({7: square, 11: triangle})
+    layer = mapbox_vector_tile.decode(index.tile(tiles.tile_maxzoom, 3, 5, {7, 11}, "boundaries"),
+                                      default_options={"y_coord_down": True})["boundaries"]
+    assert layer["extent"] == tiles.extent
+    features = {feature["id"]: feature["geometry"] for feature in layer["features"]}
+    assert features[7]["type"] == "Polygon"
+    assert [[tuple(point) for point in ring] for ring in features[7]["coordinates"]] == \
+        [ring + ring[:1] for ring in square]
+    assert [[tuple(point) for point in ring] for ring in features[11]["coordinates"]] == \
+        [ring + ring[:1] for ring in triangle]
@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from geometry import geometry_sources
+
+# Vector tiles of the zone and zip boundaries, for the optional tile mode of
+# the app (VECTOR_TILES=1). The Mapbox vector tiles of zooms 0 to
+# tile_maxzoom are computed when the store is built, one feature per
+# boundary, identified by its location id or zip code and without
+# properties. The tile server only picks the features of the requested ids
+# (one color class of a map) from the stored tile and frames them, deeper
+# zooms are scaled from the tile of tile_maxzoom containing them. Building
+# the tiles needs shapely.
+#
+#   python tiles.py        prints the number and size of the tiles
+
+tile_path = "tiles"
+tile_maxzoom = 14
+# tile coordinates run from 0 to extent, features are clipped to buffer
+# units around the tile
+extent = 4096
+buffer = 64
+
+log = logging.getLogger(__name__)
+
+# files of a map in tile_path, with prefix <map id>-
+tile_columns = [
+    # (z << 48) | (x << 24) | y of each tile, sorted
+    "tile_keys",
+    # rows of the features of tile k in feature_ids, from tile_offsets[k] to
+    # tile_offsets[k + 1]
+    "tile_offsets",
+    # id of each feature and its packed geometry commands in geometry, from
+    # geometry_offsets[i] to geometry_offsets[i + 1]
+    "feature_ids", "geometry_offsets", "geometry",
+    # a point inside each boundary, by id, where the app puts its hover
+    "point_ids", "point_lonlat",
+]
+
+def tile_key(z, x, y):
+    return (z << 48) | (x << 24) | y
+
+def world(lon, lat, z):
+    # web mercator coordinates at zoom z, in tiles
+    scale = 2**z
+    x = (lon + 180) / 360 * scale
+    y = (1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * scale
+    return x, y
+
+def _varints(values):
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+def _read_varints(data):
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            values.append(value)
+            value = shift = 0
+    return values
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+def _unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def _message(field, payload):
+    # length-delimited protobuf field
+    return _varints([(field << 3) | 2, len(payload)]) + payload
+
+def encode_rings(rings):
+    # geometry commands of polygons given as rings of integer tile
+    # coordinates, without their closing point
+    commands = []
+    cx = cy = 0
+    for ring in rings:
+        commands.append((1 << 3) | 1)
+        for i, (x, y) in enumerate(ring):
+            if i == 1:
+                commands.append(((len(ring) - 1) << 3) | 2)
+            commands += [_zigzag(x - cx), _zigzag(y - cy)]
+            cx, cy = x, y
+        commands.append((1 << 3) | 7)
+    return commands
+
+def decode_rings(commands):
+    rings = []
+    cx = cy = 0
+    i = 0
+    while i < len(commands):
+        command, count = commands[i] & 7, commands[i] >> 3
+        i += 1
+        if command == 7:
+            continue
+        if command == 1:
+            rings.append([])
+        for _ in range(count):
+            cx += _unzigzag(commands[i])
+            cy += _unzigzag(commands[i + 1])
+            rings[-1].append((cx, cy))
+            i += 2
+    return rings
+
+def _signed_area(points):
+    # shoelace area of a ring, positive for the exterior rings of the tile
+    # format, clockwise with y pointing down
+    x, y = points[:, 0], points[:, 1]
+    return (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2
+
+def _polygon_rings(polygon):
+    # rings of a clipped polygon in integer tile coordinates, oriented with
+    # a positive exterior area as the tile format requires, degenerate
+    # rings left out
+    rings = []
+    for k, ring in enumerate([polygon.exterior] + list(polygon.interiors)):
+        points = np.asarray(ring.coords, dtype=np.int64)[:-1]
+        keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+        points = points[keep]
+        area = _signed_area(points) if len(points) >= 3 else 0
+        if area == 0:
+            if k == 0:
+                return []
+            continue
+        # exterior positive, interiors negative
+        if (area > 0) != (k == 0):
+            points = points[::-1]
+        rings.append([(int(x), int(y)) for x, y in points])
+    return rings
+
+def map_tiles(path, id_property):
+    # columns of tile_columns of the features of a geojson file
+    import shapely
+    from shapely.geometry import shape
+
+    with open(path) as f:
+        features = json.load(f)["features"]
+    ids = np.array([int(feature["properties"][id_property]) for feature in features])
+    lonlat = np.array([shape(feature["geometry"]) for feature in features])
+    lonlat = np.array([geometry if geometry.is_valid else geometry.buffer(0) for geometry in lonlat])
+
+    # largest feature of each id
+    areas = shapely.area(lonlat)
+    largest = {}
+    for i in np.argsort(areas):
+        largest[ids[i]] = i
+    point_ids = np.array(sorted(largest))
+    points = shapely.point_on_surface(lonlat[[largest[i] for i in point_ids]])
+    point_lonlat = shapely.get_coordinates(points)
+
+    keys, tile_offsets, feature_ids, geometry_offsets, geometry = [], [0], [], [0], []
+    size = 0
+    for z in range(tile_maxzoom + 1):
+        tiles = shapely.transform(lonlat, lambda coords: np.column_stack(world(coords[:, 0], coords[:, 1], z)))
+        # simplified to half a pixel of a 256 pixels tile
+        tiles = shapely.simplify(tiles, 0.5 / 256, preserve_topology=True)
+        tree = shapely.STRtree(tiles)
+        xmin, ymin, xmax, ymax = shapely.total_bounds(tiles)
+        margin = buffer / extent
+        for x in range(int(xmin - margin), int(xmax + margin) + 1):
+            for y in range(int(ymin - margin), int(ymax + margin) + 1):
+                hits = tree.query(shapely.box(x - margin, y - margin, x + 1 + margin, y + 1 + margin),
+                                  predicate="intersects")
+                if not len(hits):
+                    continue
+                clipped = shapely.clip_by_rect(tiles[hits], x - margin, y - margin,
+                                               x + 1 + margin, y + 1 + margin)
+                local = shapely.transform(clipped, lambda coords: np.round(
+                    (coords - [x, y]) * extent))
+                nfeatures = 0
+                for i, feature in zip(hits, local):
+                    rings = [ring for polygon in shapely.get_parts(feature)
+                             if polygon.geom_type == "Polygon" and not polygon.is_empty
+                             for ring in [_polygon_rings(polygon)] if ring]
+                    if not rings:
+                        continue
+                    packed = _varints(encode_rings([ring for polygon in rings for ring in polygon]))
+                    feature_ids.append(ids[i])
+                    geometry.append(packed)
+                    size += len(packed)
+                    geometry_offsets.append(size)
+                    nfeatures += 1
+                if nfeatures:
+                    keys.append(tile_key(z, x, y))
+                    tile_offsets.append(tile_offsets[-1] + nfeatures)
+    return {
+        "tile_keys": np.array(keys, dtype=np.int64),
+        "tile_offsets": np.array(tile_offsets, dtype=np.int64),
+        "feature_ids": np.array(feature_ids, dtype=np.int64),
+        "geometry_offsets": np.array(geometry_offsets, dtype=np.int64),
+        "geometry": np.frombuffer(b"".join(geometry), dtype=np.uint8),
+        "point_ids": point_ids.astype(np.int64),
+        "point_lonlat": point_lonlat,
+    }
+
+def has_tiles(path):
+    # whether the store directory path has the tiles of every map
+    return all(os.path.exists(os.path.join(path, tile_path, "{}-{}.npy".format(map_id, name)))
+               for map_id in geometry_sources for name in tile_columns)
+
+def write_tiles(path):
+    # writes the tiles of every map to the store directory path
+    try:
+        import shapely
+    except ImportError:
+        log.warning("shapely is not installed, the vector tiles are not built")
+        return
+    os.makedirs(os.path.join(path, tile_path), exist_ok=True)
+    for map_id, (source_path, id_property, key_property, simpler_path) in geometry_sources.items():
+        for name, values in map_tiles(source_path, id_property).items():
+            np.save(os.path.join(path, tile_path, "{}-{}.npy".format(map_id, name)), values,
+                    allow_pickle=False)
+
+class TileIndex:
+    # read-only memory-mapped tiles of one map of a built store
+    def __init__(self, path, map_id):
+        for name in tile_columns:
+            setattr(self, name, np.load(os.path.join(path, tile_path, "{}-{}.npy".format(map_id, name)),
+                                        mmap_mode="r", allow_pickle=False))
+        self.points = {int(point_id) : (float(lon), float(lat))
+                       for point_id, (lon, lat) in zip(self.point_ids, self.point_lonlat)}
+
+    def features(self, z, x, y):
+        # rows of the features of a stored tile
+        key = tile_key(z, x, y)
+        k = int(np.searchsorted(self.tile_keys, key))
+        if k == len(self.tile_keys) or self.tile_keys[k] != key:
+            return range(0)
+        return range(int(self.tile_offsets[k]), int(self.tile_offsets[k + 1]))
+
+    def tile(self, z, x, y, ids, layer):
+        # Mapbox vector tile with the features of the given ids in a layer
+        # of that name, b"" if there are none
+        if not 0 <= x < 2**z or not 0 <= y < 2**z:
+            return b""
+        scale = 1
+        if z > tile_maxzoom:
+            # features of the containing tile, scaled and shifted so that
+            # the tile spans 0..extent, outside of it they are clipped by
+            # the renderer
+            scale = 2**(z - tile_maxzoom)
+            offset_x, offset_y = (x % scale) * extent, (y % scale) * extent
+            z, x, y = tile_maxzoom, x // scale, y // scale
+        features = []
+        for row in self.features(z, x, y):
+            feature_id = int(self.feature_ids[row])
+            if feature_id not in ids:
+                continue
+            packed = bytes(self.geometry[self.geometry_offsets[row]:self.geometry_offsets[row + 1]])
+            if scale > 1:
+                rings = decode_rings(_read_varints(packed))
+                packed = _varints(encode_rings([[(px * scale - offset_x, py * scale - offset_y)
+                                                 for px, py in ring] for ring in rings]))
+            # id, type polygon, geometry
+            features.append(_message(2, _varints([1 << 3, feature_id, 3 << 3, 3])
+                                        + _message(4, packed)))
+        if not features:
+            return b""
+        # version 2, name, features, extent
+        payload = _varints([15 << 3, 2]) + _message(1, layer.encode()) + b"".join(features) \
+            + _varints([5 << 3, extent])
+        return _message(3, payload)
+
+# main
+if __name__ == "__main__":
+    for map_id, (source_path, id_property, key_property, simpler_path) in geometry_sources.items():
+        columns = map_tiles(source_path, id_property)
+        print("{}: {} tiles, {} features, {} bytes of geometry".format(
+            map_id, len(columns["tile_keys"]), len(columns["feature_ids"]), len(columns["geometry"])))
@@ -0,0 +1,87 @@
+import numpy as np
+
+# vectorized versions of the per-zone transforms, every function takes and
+# returns whole columns (lists, Series or 1d arrays) instead of single values
+
+def myLog(x):
+    # log(x) where x > 0, 0 elsewhere
+    x = np.asarray(x, dtype=np.float64)
+    positive = x > 0
+    return np.where(positive, np.log(np.where(positive, x, 1)), 0)
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-np.asarray(x, dtype=np.float64)))
+
+def newLog(x):
+    # x where x <= 0, log(x+1) elsewhere
+    x = np.asarray(x, dtype=np.float64)
+    return np.where(x <= 0, x, np.log(np.maximum(x, 0) + 1))
+    # return np.sign(x)*np.log(abs(x)+1)
+
+def safe_ratio(num, den):
+    # num / den, with the nan and +-inf of empty denominators set to 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.asarray(num, dtype=np.float64) / den
+    ratio[~np.isfinite(ratio)] = 0
+    return ratio
+
+def set_interval_value(x, a, b):
+    # associates to every value of x its position with respect to the
+    # interval [a, b]: 0 if x <= a, 1 if a < x <= b, 2 otherwise (nan included)
+    return np.digitize(np.asarray(x, dtype=np.float64), [a, b], right=True)
+
+def data2color(x, y, a, b, c, d, biv_colors):
+    # This function works only with a list of 9 bivariate colors,
+    # because of the definition of set_interval_value()
+    # x, y: lists or 1d arrays, containing values of the two variables
+    #  each x[k], y[k] is mapped to an int  value xv, respectively yv, representing its category,
+    # from which we get their corresponding color  in the list of bivariate colors
+    if len(x) != len(y):
+        raise ValueError('the list of x and y-coordinates must have the same length')
+    n_colors = len(biv_colors)
+    if n_colors != 9:
+        raise ValueError('the list of bivariate colors must have the length eaqual to 9')
+    n = 3
+    # index of the corresponding color in the list of bivariate colors
+    idxcol = set_interval_value(x, a, b) + n*set_interval_value(y, c, d)
+    return np.array(biv_colors)[idxcol]
+
+def percentile_colors(x, y, biv_colors):
+    # bivariate colors of x and y binned at their 33rd and 66th percentiles
+    x_percentiles = np.percentile(x, [33, 66])
+    y_percentiles = np.percentile(y, [33, 66])
+    return data2color(x, y,
+                        a=x_percentiles[0], b=x_percentiles[1],
+                        c=y_percentiles[0], d=y_percentiles[1],
+                        biv_colors=biv_colors)
+
+def amount_columns(yellow, green, biv_colors):
+    # derived taxi columns of the raw revenue view, from the yellow and green
+    # revenue of every zone over the selected months
+    total = yellow + green
+    return {"yellow_total_amount": yellow,
+            "green_total_amount": green,
+            "biv_amount_color": percentile_colors(myLog(yellow), myLog(green), biv_colors),
+            "total_amount": total,
+            "log_total_amount": myLog(total)}
+
+def ratio_columns(yellow2019, green2019, yellow2020, green2020, nmonths, biv_colors):
+    # derived taxi columns of the ratio view, from the yellow and green revenue
+    # of every zone over the same selected months of 2019 and 2020
+    yellowratio = safe_ratio(yellow2019 - yellow2020, yellow2019) / nmonths
+    greenratio = safe_ratio(green2019 - green2020, green2019) / nmonths
+    totalratio = safe_ratio(green2019 - green2020 + yellow2019 - yellow2020,
+                                green2019 + yellow2019) / nmonths
+    total = yellow2020 + green2020
+    total_change_percent = -totalratio * 100
+    return {"yellow_total_amount": yellow2020,
+            "green_total_amount": green2020,
+            "yellow_change_percent": -yellowratio * 100,
+            "green_change_percent": -greenratio * 100,
+            "total_change_percent": total_change_percent,
+            "biv_ratio_color": percentile_colors(yellowratio, greenratio, biv_colors),
+            "total_amount": total,
+            "log_total_amount": myLog(total),
+            "log_total_change_percent": myLog(total_change_percent),
+            "sigmoid_total_change_percent": sigmoid(total_change_percent),
+            "newlog_total_change_percent": newLog(total_change_percent)}